@@ -0,0 +1,318 @@
+import os, sys, json
+import argparse
+import shutil
+import random
+import subprocess
+import tempfile
+import platform
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+#every stage runs in its own child process, so peak memory is per stage and imgdb's output doesn't get in the way
+BENCH_STAGES = ['scan', 'rescan', 'hash', 'imghash', 'pal', 'ocr']
+STAGE_RESULT_FILE = "stageresult.json"
+CORPUS_INFO_FILE = "corpus.json"
+CORPUS_SEED = 1234
+
+#(name, width, height, count)
+corpusSizes = [
+	('icon', 32, 32, 40),
+	('thumb', 200, 150, 60),
+	('web', 1280, 720, 40),
+	('photo', 4000, 3000, 8),
+	('huge', 8660, 5774, 1)
+]
+
+stubTesseract = '''#!{0}
+import sys, os
+args = sys.argv[1:]
+if '--version' in args:
+	print("tesseract 5.3.0")
+	sys.exit(0)
+if '--list-langs' in args:
+	print('List of available languages in "stub" (1):')
+	print('eng')
+	sys.exit(0)
+inputPath = args[0]
+if inputPath.endswith('.txt'):
+	with open(inputPath, encoding='utf8') as listFile:
+		paths = [x.strip() for x in listFile if x.strip()]
+else:
+	paths = [inputPath]
+text = "".join("text of {{0}}\\n\\f".format(os.path.basename(x)) for x in paths)
+if args[1] in ('stdout', '-'):
+	sys.stdout.write(text)
+else:
+	with open(args[1] + '.txt', 'w', encoding='utf8') as outFile:
+		outFile.write(text)
+'''
+
+def makeImage(rnd: random.Random, width: int, height: int, withText: bool) -> Image.Image:
+	#smooth noise blown up to size looks enough like a photo to keep encoders and palettes honest
+	noise = np.random.default_rng(rnd.getrandbits(32)).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+	img = Image.fromarray(noise, 'RGB').resize((width, height), Image.BICUBIC)
+	draw = ImageDraw.Draw(img)
+	for i in range(rnd.randint(0, 6)):
+		x0 = rnd.randint(0, width - 1)
+		y0 = rnd.randint(0, height - 1)
+		draw.rectangle([x0, y0, x0 + rnd.randint(1, width // 2 + 1), y0 + rnd.randint(1, height // 2 + 1)],
+			fill=tuple(rnd.randint(0, 255) for x in range(3)))
+	if withText and (width >= 64):
+		font = ImageFont.load_default(size=max(10, height // 20))
+		for i in range(rnd.randint(1, 5)):
+			draw.text((rnd.randint(0, width // 2), rnd.randint(0, height - 1)), "Lorem ipsum dolor sit amet",
+				fill=(0, 0, 0), font=font)
+	return img
+
+def saveImage(img: Image.Image, path: str) -> None:
+	ext = os.path.splitext(path)[1].lower()
+	if ext in ('.jpg', '.jpeg'):
+		img.save(path, quality=90)
+	elif ext == '.png':
+		img.save(path, compress_level=1)
+	else:
+		img.save(path)
+
+def makeCorpus(corpusDir: str, extensions: list[str], scale: float) -> dict:
+	rnd = random.Random(CORPUS_SEED)
+	dirs = ['img']
+	for i in range(6):
+		parent = rnd.choice(dirs)
+		if parent.count('/') < 3:
+			dirs.append("{0}/d{1}".format(parent, i))
+	for curDir in dirs:
+		os.makedirs(os.path.join(corpusDir, curDir), exist_ok=True)
+
+	paths = []
+	for name, width, height, count in corpusSizes:
+		count = max(int(round(count * scale)), 1)
+		for i in range(count):
+			ext = rnd.choice(extensions)
+			if (ext == '.tga') and (width * height > 4000000):
+				ext = '.png'
+			path = "{0}/{1}{2}{3}".format(rnd.choice(dirs), name, i, ext)
+			saveImage(makeImage(rnd, width, height, rnd.random() < 0.2), os.path.join(corpusDir, path))
+			paths.append(path)
+		print("made {0} {1} image(s) of {2}x{3}".format(count, name, width, height))
+
+	#exact copies elsewhere, for hashing and duplicate handling
+	numDuplicates = max(len(paths) // 10, 1)
+	for i in range(numDuplicates):
+		source = rnd.choice(paths)
+		target = "{0}/copy{1}{2}".format(rnd.choice(dirs), i, os.path.splitext(source)[1])
+		shutil.copyfile(os.path.join(corpusDir, source), os.path.join(corpusDir, target))
+		paths.append(target)
+
+	return {
+		'files': len(paths),
+		'bytes': sum(os.path.getsize(os.path.join(corpusDir, x)) for x in paths),
+		'dirs': len(dirs),
+		'duplicates': numDuplicates,
+		'scale': scale,
+		'seed': CORPUS_SEED
+	}
+
+def writeStubTesseract(workDir: str) -> str:
+	stubPath = os.path.join(workDir, "stubtesseract.py")
+	with open(stubPath, "w", encoding="utf8") as outFile:
+		outFile.write(stubTesseract.format(sys.executable))
+	if os.name == 'nt':
+		batPath = os.path.join(workDir, "stubtesseract.bat")
+		with open(batPath, "w", encoding="utf8") as outFile:
+			outFile.write('@"{0}" "{1}" %*\n'.format(sys.executable, stubPath))
+		return batPath
+	os.chmod(stubPath, 0o755)
+	return stubPath
+
+def resetPeakRss() -> bool:
+	#linux keeps ru_maxrss across exec, a stage process would report bench.py's own peak. VmHWM can be reset, ru_maxrss can't
+	try:
+		with open("/proc/self/clear_refs", "w") as outFile:
+			outFile.write("5")
+		return True
+	except OSError:
+		return False
+
+def getOwnPeakRss() -> int:
+	#kB since resetPeakRss
+	with open("/proc/self/status", "r") as inFile:
+		for line in inFile:
+			if line.startswith("VmHWM:"):
+				return int(line.split()[1])
+	return 0
+
+def getPeakRss(peakReset: bool) -> float:
+	#MB, workers included once they've exited
+	try:
+		import resource
+	except ImportError:
+		return 0.0
+	ownPeak = getOwnPeakRss() if peakReset else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	peak = max(ownPeak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def getStageTotals(imgdb, dbProc, stage: str) -> tuple[int, int]:
+	#rows the stage is responsible for and the bytes of the files behind them
+	func = imgdb.func
+	query = {
+		'scan': dbProc.session.query(func.count(imgdb.FileData.id), func.sum(imgdb.FileData.size)),
+		'rescan': dbProc.session.query(func.count(imgdb.FileData.id), func.sum(imgdb.FileData.size)),
+		'hash': dbProc.session.query(func.count(imgdb.FileData.id), func.sum(imgdb.FileData.size))
+			.filter(imgdb.FileData.hash != imgdb.DEFAULT_HASH),
+		'imghash': dbProc.session.query(func.count(imgdb.DHashData.id), func.sum(imgdb.DHashData.size)),
+		'pal': dbProc.session.query(func.count(imgdb.PaletteData.id), func.sum(imgdb.PaletteData.size)),
+		'ocr': dbProc.session.query(func.count(imgdb.OcrData.id), func.sum(imgdb.OcrData.size))
+	}[stage]
+	count, size = query.one()
+	return (count or 0, size or 0)
+
+def runStage(stage: str, workDir: str) -> None:
+	os.chdir(workDir)
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import imgdb
+	dbProc = imgdb.DbProcessor()
+	stageCalls = {
+		'scan': lambda: dbProc.scanFilesystem(),
+		'rescan': lambda: dbProc.scanFilesystem(),
+		'hash': lambda: dbProc.buildHashes(),
+		'imghash': lambda: dbProc.buildDhashes(),
+		'pal': lambda: dbProc.buildPalettes(),
+		'ocr': lambda: dbProc.buildOcr()
+	}
+	startCount, startBytes = getStageTotals(imgdb, dbProc, stage)
+	peakReset = resetPeakRss()
+	startTime = time.perf_counter()
+	stageCalls[stage]()
+	elapsed = time.perf_counter() - startTime
+	endCount, endBytes = getStageTotals(imgdb, dbProc, stage)
+	if stage in ('scan', 'rescan'):
+		#a scan looks at every file, whether or not it changed anything
+		numFiles, numBytes = endCount, endBytes
+	else:
+		numFiles, numBytes = endCount - startCount, endBytes - startBytes
+	result = {
+		'seconds': elapsed,
+		'files': numFiles,
+		'bytes': numBytes,
+		'filesPerSecond': numFiles / elapsed if elapsed > 0 else 0.0,
+		'mbPerSecond': numBytes / (1024.0 * 1024.0) / elapsed if elapsed > 0 else 0.0,
+		'peakRssMb': getPeakRss(peakReset)
+	}
+	with open(STAGE_RESULT_FILE, "w", encoding="utf8") as outFile:
+		json.dump(result, outFile)
+
+def runMakeCorpus(workDir: str, scale: float) -> None:
+	#separate process, so the images made here don't show up in the peak memory of the stages started after it
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import imgdb
+	shutil.rmtree(os.path.join(workDir, "img"), ignore_errors=True)
+	corpus = makeCorpus(workDir, imgdb.Config().extensions, scale)
+	with open(os.path.join(workDir, CORPUS_INFO_FILE), "w", encoding="utf8") as outFile:
+		json.dump(corpus, outFile, indent='\t')
+
+def runBenchmark(args) -> dict:
+	import imgdb
+	config = imgdb.Config()
+	ownDir = args.workdir is None
+	workDir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="imgdbbench")
+	try:
+		corpusInfoPath = os.path.join(workDir, CORPUS_INFO_FILE)
+		if os.path.isfile(corpusInfoPath) and not args.newcorpus:
+			print("reusing corpus in {0}".format(workDir))
+		else:
+			print("making corpus in {0}".format(workDir))
+			if os.path.isfile(corpusInfoPath):
+				os.remove(corpusInfoPath)
+			subprocess.run([sys.executable, os.path.abspath(__file__), '--makecorpus', '--workdir', workDir, '--scale', str(args.scale)],
+				check=True)
+		with open(corpusInfoPath, "r", encoding="utf8") as inFile:
+			corpus = json.load(inFile)
+		print("corpus: {0} files, {1:.1f} MB".format(corpus['files'], corpus['bytes'] / (1024.0 * 1024.0)))
+
+		#fresh database and config every run
+		config.paths = ['img']
+		config.excludePaths = []
+		config.dbpath = 'bench.db'
+		config.tesscmd = writeStubTesseract(workDir)
+		for name in os.listdir(workDir):
+			if name.startswith(config.dbpath):
+				os.remove(os.path.join(workDir, name))
+		config.save(os.path.join(workDir, imgdb.Config.DEFAULT_PATH))
+
+		stages = {}
+		for stage in args.stages.split(','):
+			stage = stage.strip()
+			if stage not in BENCH_STAGES:
+				print("unknown stage {0}, expected one of {1}".format(stage, ", ".join(BENCH_STAGES)))
+				continue
+			resultPath = os.path.join(workDir, STAGE_RESULT_FILE)
+			if os.path.isfile(resultPath):
+				os.remove(resultPath)
+			output = None if args.verbose else subprocess.DEVNULL
+			subprocess.run([sys.executable, os.path.abspath(__file__), '--runstage', stage, '--workdir', workDir],
+				stdout=output, stderr=output, check=True)
+			with open(resultPath, "r", encoding="utf8") as inFile:
+				stages[stage] = json.load(inFile)
+			printStage(stage, stages[stage])
+
+		return {
+			'date': datetime.now().isoformat(timespec='seconds'),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'cpus': os.cpu_count(),
+			'corpus': corpus,
+			'stages': stages
+		}
+	finally:
+		if ownDir:
+			shutil.rmtree(workDir, ignore_errors=True)
+
+def printStage(stage: str, result: dict, baseline: dict = None) -> None:
+	line = "{0:>8}: {1:8.2f}s {2:9.1f} files/s {3:8.1f} MB/s {4:8.1f} MB peak".format(
+		stage, result['seconds'], result['filesPerSecond'], result['mbPerSecond'], result['peakRssMb'])
+	if baseline and baseline.get('seconds'):
+		line += " ({0:.2f}x)".format(baseline['seconds'] / max(result['seconds'], 1e-9))
+	print(line)
+
+def compareResults(result: dict, baselinePath: str) -> None:
+	with open(baselinePath, "r", encoding="utf8") as inFile:
+		baseline = json.load(inFile)
+	if baseline.get('corpus') != result.get('corpus'):
+		print("warning: corpus differs from {0}, numbers aren't directly comparable".format(baselinePath))
+	print("compared to {0} ({1}), speedup in brackets:".format(baselinePath, baseline.get('date')))
+	for stage, stageResult in result['stages'].items():
+		printStage(stage, stageResult, baseline['stages'].get(stage))
+
+def main():
+	parse = argparse.ArgumentParser(description="benchmark imgdb stages on a generated image corpus")
+	parse.add_argument("--stages", help="comma separated stages to run, in order", action="store", default=",".join(BENCH_STAGES))
+	parse.add_argument("--scale", help="multiplier for the number of images of each size", action="store", type=float, default=1.0)
+	parse.add_argument("--workdir", help="keep corpus here and reuse it between runs instead of a temporary directory", action="store", default=None)
+	parse.add_argument("--newcorpus", help="regenerate the corpus in --workdir", action="store_true")
+	parse.add_argument("--output", help="json file for the results", action="store", default=None)
+	parse.add_argument("--compare", help="json results of an earlier run to compare against", action="store", default=None)
+	parse.add_argument("--verbose", help="show imgdb output", action="store_true")
+	parse.add_argument("--runstage", help=argparse.SUPPRESS, action="store", default=None)
+	parse.add_argument("--makecorpus", help=argparse.SUPPRESS, action="store_true")
+	args = parse.parse_args()
+
+	if args.makecorpus:
+		runMakeCorpus(args.workdir, args.scale)
+		return
+	if args.runstage:
+		runStage(args.runstage, args.workdir)
+		return
+
+	result = runBenchmark(args)
+	outputPath = args.output or "bench-{0}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+	with open(outputPath, "w", encoding="utf8") as outFile:
+		json.dump(result, outFile, indent='\t')
+	print("results saved to {0}".format(outputPath))
+	if args.compare:
+		compareResults(result, args.compare)
+
+if __name__ == "__main__":
+	main()
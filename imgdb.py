@@ -1,16 +1,32 @@
-import os, json, sys
-from sqlalchemy import Column, Integer, String, DateTime
+import os, json, sys, re
+import zlib
+import base64
+import tempfile
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, Index
 from sqlalchemy import create_engine
 from sqlalchemy import tuple_
 import sqlalchemy
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqliteInsert
 from sqlalchemy.ext.declarative import declarative_base
 from pathlib import Path
 from datetime import datetime
 import hashlib
+import random
+import stat
 import time
-
-from PIL import Image
+import mmap
+import threading
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import contextlib
+import cProfile
+import pstats
+
+from PIL import Image, ImageChops
 import dhash
 import pytesseract
 import numpy as np
@@ -18,17 +34,25 @@ import numpy as np
 from sqlalchemy.sql import exists
 from sqlalchemy.sql.expression import func
 
-from itertools import zip_longest, groupby
+import itertools
 
 import argparse
 import subprocess
 import multiprocessing as mp
+import multiprocessing.pool
 from typing import Optional
 
 Base = declarative_base()
 
 DB_PATH = 'imgdb.db'
 DEFAULT_HASH = ""
+OCR_FTS_TABLE = "ocr_fts"
+PATH_FTS_TABLE = "files_trigram"
+#fts table: (source table, columns, fts5 options, columns whose update reindexes the row)
+FTS_INDEXES = {
+	OCR_FTS_TABLE: ('ocr', ['text', 'lang UNINDEXED'], "tokenize = 'unicode61 remove_diacritics 2'", 'text, lang'),
+	PATH_FTS_TABLE: ('files', ['path'], "tokenize = 'trigram'", 'path')
+}
 
 class FileData(Base):
 	__tablename__ = 'files'
@@ -40,29 +64,31 @@ class FileData(Base):
 	mtime = Column(DateTime)
 
 	hash = Column(String, index=True)
+	#st_ino/st_dev when the filesystem has them, tells a moved file from a copy
+	inode = Column(Integer)
+	device = Column(Integer)
 	def __str__(self) -> str:
-		return "FileData: {{id: {0}, path: '{1}', size: {2}, ctime: {3}, mtime: {4}, hash: {5}}}".format(
-			self.id, self.path, self.size, self.ctime, self.mtime, self.hash
+		return "FileData: {{id: {0}, path: '{1}', size: {2}, ctime: {3}, mtime: {4}, hash: {5}, inode: {6}, device: {7}}}".format(
+			self.id, self.path, self.size, self.ctime, self.mtime, self.hash, self.inode, self.device
 		)
 
-class ScanFileData(Base):
-	__tablename__ = 'scanfiles'
-
+class DirData(Base):
+	__tablename__ = 'dirs'
 	id = Column(Integer, primary_key=True)
 	path = Column(String, unique=True)
-	size = Column(Integer)
-	ctime = Column(DateTime)
+	parent = Column(String, index=True)
 	mtime = Column(DateTime)
-
+	listed = Column(DateTime)
 	def __str__(self) -> str:
-		return "ScanFileData: {{id: {0}, path: '{1}', size: {2}, ctime: {3}, mtime: {4}}}".format(
-			self.id, self.path, self.size, self.ctime, self.mtime
+		return "DirData: {{id: {0}, path: '{1}', parent: '{2}', mtime: {3}, listed: {4}}}".format(
+			self.id, self.path, self.parent, self.mtime, self.listed
 		)
 
 class DHashData(Base):
 	__tablename__ = 'dhashes'
+	__table_args__ = (Index('ux_dhashes_hash_hashSize', 'hash', 'hashSize', unique=True),)
 	id = Column(Integer, primary_key=True)
-	hash = Column(String, index=True)
+	hash = Column(String)
 	size = Column(Integer, index=True)
 
 	hashSize = Column(Integer)
@@ -74,29 +100,69 @@ class DHashData(Base):
 
 class PaletteData(Base):
 	__tablename__ = 'palettes'
+	__table_args__ = (Index('ux_palettes_hash', 'hash', unique=True),)
 	id = Column(Integer, primary_key=True)
-	hash = Column(String, index=True)
+	hash = Column(String)
 	size = Column(Integer, index=True)
 
 	palette = Column(String, index=True)
+	histogram = Column(LargeBinary)
+	colorMask = Column(Integer, index=True)
+	mainColor = Column(String, index=True)
 	def __str__(self) -> str:
-		return "PaletteData: {{id: {0}, hash: '{1}', size: {2}, palette: {3}}}".format(
-			self.id, self.hash, self.size, self.palette
+		return "PaletteData: {{id: {0}, hash: '{1}', size: {2}, palette: {3}, colorMask: {4}, mainColor: {5}, histogram: {6} bytes}}".format(
+			self.id, self.hash, self.size, self.palette, self.colorMask, self.mainColor, len(self.histogram) if self.histogram else 0
 		)
 
 class OcrData(Base):
 	__tablename__ = 'ocr'
+	__table_args__ = (Index('ux_ocr_hash_lang', 'hash', 'lang', unique=True),)
 	id = Column(Integer, primary_key=True)
-	hash = Column(String, index=True)
+	hash = Column(String)
 	size = Column(Integer, index=True)
 
 	lang = Column(String)
 	text = Column(String, index=True)
+	#None when tesseract ran, otherwise why it didn't
+	status = Column(String)
+	def __str__(self) -> str:
+		return "OcrData: {{id: {0}, hash: '{1}', size: {2}, lang: {3}, text: {4}, status: {5}}}".format(
+			self.id, self.hash, self.size, self.lang, self.text, self.status
+		)
+
+class StageCheckpoint(Base):
+	__tablename__ = 'checkpoints'
+	id = Column(Integer, primary_key=True)
+	stage = Column(String, unique=True)
+	position = Column(String)
+	processed = Column(Integer)
+	updated = Column(DateTime)
+	def __str__(self) -> str:
+		return "StageCheckpoint: {{id: {0}, stage: '{1}', position: '{2}', processed: {3}, updated: {4}}}".format(
+			self.id, self.stage, self.position, self.processed, self.updated
+		)
+
+class TableGeneration(Base):
+	#bumped by triggers whenever rows of a table are deleted or changed. The token is new for every database file
+	__tablename__ = 'generations'
+	id = Column(Integer, primary_key=True)
+	name = Column(String, unique=True)
+	token = Column(Integer)
+	generation = Column(Integer)
 	def __str__(self) -> str:
-		return "OcrData: {{id: {0}, hash: '{1}', size: {2}, lang: {3}, text: {4}}}".format(
-			self.id, self.hash, self.size, self.lang, self.text
+		return "TableGeneration: {{id: {0}, name: '{1}', token: {2}, generation: {3}}}".format(
+			self.id, self.name, self.token, self.generation
 		)
 
+def makeInsert(table):
+	#rows that would break a unique constraint are skipped, whatever is already in the database stays
+	return sqliteInsert(table).on_conflict_do_nothing()
+
+def deleteDuplicates(conn, table, columns: list[str]) -> int:
+	#keeps the oldest row of each group
+	keepIds = sqlalchemy.select(func.min(table.c.id)).group_by(*[table.c[x] for x in columns])
+	return conn.execute(sqlalchemy.delete(table).where(table.c.id.not_in(keepIds))).rowcount
+
 class OperationInterruptedException(Exception):
 	pass
 
@@ -106,6 +172,20 @@ class Config:
 	KEY_TESSCMD = 'tesscmd'
 	KEY_EXCLUDE_PATHS = 'excludePaths'
 	KEY_EXTENSIONS = 'extensions'
+	KEY_HASH_WORKERS = 'hashWorkers'
+	KEY_HASH_POOL = 'hashPool'
+	KEY_HASH_MMAP = 'hashMmap'
+	KEY_COMMIT_ROWS = 'commitRows'
+	KEY_COMMIT_SECONDS = 'commitSeconds'
+	KEY_WORK_SIZE = 'workSize'
+	KEY_SQLITE_PRAGMAS = 'sqlitePragmas'
+	KEY_OCR_WORKERS = 'ocrWorkers'
+	KEY_OCR_BATCH = 'ocrBatch'
+	KEY_OCR_MIN_TEXT_BLOCKS = 'ocrMinTextBlocks'
+	KEY_OCR_TIMEOUT = 'ocrTimeout'
+	KEY_OCR_MAX_PIXELS = 'ocrMaxPixels'
+	KEY_OCR_MAX_DPI = 'ocrMaxDpi'
+	KEY_PROGRESS_SECONDS = 'progressSeconds'
 	DEFAULT_PATH = 'imgdbcfg.json'
 	def save(self, path) -> None:
 		with open(path, mode="w", encoding="utf8") as outFile:
@@ -115,6 +195,20 @@ class Config:
 			data[Config.KEY_TESSCMD] = self.tesscmd
 			data[Config.KEY_EXCLUDE_PATHS] = self.excludePaths
 			data[Config.KEY_EXTENSIONS] = self.extensions
+			data[Config.KEY_HASH_WORKERS] = self.hashWorkers
+			data[Config.KEY_HASH_POOL] = self.hashPool
+			data[Config.KEY_HASH_MMAP] = self.hashMmap
+			data[Config.KEY_COMMIT_ROWS] = self.commitRows
+			data[Config.KEY_COMMIT_SECONDS] = self.commitSeconds
+			data[Config.KEY_WORK_SIZE] = self.workSize
+			data[Config.KEY_SQLITE_PRAGMAS] = self.sqlitePragmas
+			data[Config.KEY_OCR_WORKERS] = self.ocrWorkers
+			data[Config.KEY_OCR_BATCH] = self.ocrBatch
+			data[Config.KEY_OCR_MIN_TEXT_BLOCKS] = self.ocrMinTextBlocks
+			data[Config.KEY_OCR_TIMEOUT] = self.ocrTimeout
+			data[Config.KEY_OCR_MAX_PIXELS] = self.ocrMaxPixels
+			data[Config.KEY_OCR_MAX_DPI] = self.ocrMaxDpi
+			data[Config.KEY_PROGRESS_SECONDS] = self.progressSeconds
 
 			json.dump(data, outFile, indent='\t')
 
@@ -126,6 +220,20 @@ class Config:
 			self.tesscmd = data[Config.KEY_TESSCMD]
 			self.excludePaths = list(data[Config.KEY_EXCLUDE_PATHS])
 			self.extensions = list(data[Config.KEY_EXTENSIONS])
+			self.hashWorkers = int(data.get(Config.KEY_HASH_WORKERS, self.hashWorkers))
+			self.hashPool = data.get(Config.KEY_HASH_POOL, self.hashPool)
+			self.hashMmap = bool(data.get(Config.KEY_HASH_MMAP, self.hashMmap))
+			self.commitRows = int(data.get(Config.KEY_COMMIT_ROWS, self.commitRows))
+			self.commitSeconds = float(data.get(Config.KEY_COMMIT_SECONDS, self.commitSeconds))
+			self.workSize = int(data.get(Config.KEY_WORK_SIZE, self.workSize))
+			self.sqlitePragmas = dict(data.get(Config.KEY_SQLITE_PRAGMAS, self.sqlitePragmas))
+			self.ocrWorkers = int(data.get(Config.KEY_OCR_WORKERS, self.ocrWorkers))
+			self.ocrBatch = int(data.get(Config.KEY_OCR_BATCH, self.ocrBatch))
+			self.ocrMinTextBlocks = int(data.get(Config.KEY_OCR_MIN_TEXT_BLOCKS, self.ocrMinTextBlocks))
+			self.ocrTimeout = float(data.get(Config.KEY_OCR_TIMEOUT, self.ocrTimeout))
+			self.ocrMaxPixels = int(data.get(Config.KEY_OCR_MAX_PIXELS, self.ocrMaxPixels))
+			self.ocrMaxDpi = int(data.get(Config.KEY_OCR_MAX_DPI, self.ocrMaxDpi))
+			self.progressSeconds = float(data.get(Config.KEY_PROGRESS_SECONDS, self.progressSeconds))
 
 	def getConfig():
 		path = Config.DEFAULT_PATH
@@ -160,24 +268,333 @@ class Config:
 		self.tesscmd = ['tesseract']
 		self.excludePaths = ['img/excluded']
 		self.extensions = ['.png', '.tga', '.jpeg', '.jpg', '.bmp']
+		self.hashWorkers = 0
+		self.hashPool = 'thread'
+		self.hashMmap = False
+		self.commitRows = 1000
+		self.commitSeconds = 60.0
+		self.workSize = 0
+		#WAL with synchronous NORMAL only fsyncs at checkpoints, data stays safe, the last commits may be lost on power loss
+		self.sqlitePragmas = {
+			'journal_mode': 'WAL',
+			'synchronous': 'NORMAL',
+			'cache_size': -65536,
+			'mmap_size': 268435456,
+			'temp_store': 'MEMORY',
+			'busy_timeout': 10000
+		}
+		self.ocrWorkers = 0
+		self.ocrBatch = 16
+		self.ocrMinTextBlocks = 2
+		self.ocrTimeout = 120.0
+		self.ocrMaxPixels = 40000000
+		self.ocrMaxDpi = 300
+		self.progressSeconds = 2.0
 		pass
 	pass
 
-def getDigest(path: str):
+DIGEST_BLOCK_SIZE = 1024 * 1024 * 4
+digestBuffers = threading.local()
+
+def getDigestBuffer() -> bytearray:
+	buffer = getattr(digestBuffers, 'buffer', None)
+	if buffer is None:
+		buffer = bytearray(DIGEST_BLOCK_SIZE)
+		digestBuffers.buffer = buffer
+	return buffer
+
+def getDigest(path: str, useMmap: bool = False):
 	h = hashlib.sha256()
-	blockSize = 1024 * 1024 * 10
-	with open(path, "rb") as inFile:
+	with open(path, "rb", buffering=0) as inFile:
+		if useMmap:
+			if os.fstat(inFile.fileno()).st_size > 0:
+				with mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+					h.update(mapped)
+			return h.hexdigest()
+
+		#one buffer per worker thread, hashlib drops the GIL while it chews through it
+		buffer = getDigestBuffer()
+		view = memoryview(buffer)
 		while True:
-			chunk = inFile.read(blockSize)
-			if not chunk:
+			numRead = inFile.readinto(buffer)
+			if not numRead:
 				break
-			h.update(chunk)
+			h.update(view[:numRead])
 	return h.hexdigest()
 
-def getDHash(path: str, size: int = 8):
+def makeWorkerPool(numWorkers: int, useThreads: bool) -> mp.pool.Pool:
+	if (numWorkers <= 0):
+		numWorkers = None
+	if useThreads:
+		return mp.pool.ThreadPool(numWorkers)
+	return mp.Pool(numWorkers)
+
+def reduceImage(img: Image.Image, workSize: int) -> Image.Image:
+	if workSize <= 0:
+		return img
+	factor = min(img.size[0] // workSize, img.size[1] // workSize)
+	if factor < 2:
+		return img
+	#reduce() doesn't handle palette, bilevel and packed 16 bit images
+	if img.mode == 'P':
+		img = img.convert('RGB')
+	elif img.mode == '1':
+		img = img.convert('L')
+	elif img.mode.startswith('I;'):
+		img = img.convert('I')
+	return img.reduce(factor)
+
+def loadWorkImage(img: Image.Image, workSize: int) -> Image.Image:
+	#jpeg can skip most of the decode through DCT scaling, everything else is shrunk right after decoding
+	if workSize > 0:
+		img.draft(None, (workSize, workSize))
+	img.load()
+	return reduceImage(img, workSize)
+
+def getImageDHash(img: Image.Image, size: int = 8) -> str:
+	row, col = dhash.dhash_row_col(img, size)
+	return dhash.format_hex(row, col, size)
+
+def getDHash(path: str, size: int = 8, workSize: int = 0):
 	with Image.open(path) as img:
-		row, col = dhash.dhash_row_col(img)
-		return dhash.format_hex(row, col)
+		return getImageDHash(loadWorkImage(img, workSize), size)
+
+def parseDHashes(dhashes: list[str]) -> np.ndarray:
+	#two big endian words per 128 bit dhash: rows, then columns
+	return np.frombuffer(bytes.fromhex("".join(dhashes)), dtype='>u8').astype(np.uint64).reshape(-1, 2)
+
+byteBitCounts = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+def popcount64(values: np.ndarray) -> np.ndarray:
+	if hasattr(np, 'bitwise_count'):
+		return np.bitwise_count(values)
+	values = np.ascontiguousarray(values, dtype=np.uint64)
+	return byteBitCounts[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def getTableGeneration(session: sqlalchemy.orm.Session, table) -> tuple[int, int]:
+	#(token, generation) for files derived from a table. Ids alone can't tell, sqlite hands out the same ids again after a rebuild
+	generationTable = TableGeneration.__table__
+	query = sqlalchemy.select(generationTable.c.token, generationTable.c.generation).where(generationTable.c.name == table.name)
+	row = session.execute(query).first()
+	if row is None:
+		for action in ('DELETE', 'UPDATE'):
+			session.execute(sqlalchemy.text(
+				"CREATE TRIGGER IF NOT EXISTS {0}_generation_{1} AFTER {2} ON {0} BEGIN "
+				"UPDATE {3} SET generation = generation + 1 WHERE name = '{0}'; END".format(
+					table.name, action.lower(), action, generationTable.name)
+			))
+		session.execute(makeInsert(generationTable).values(name = table.name, token = random.getrandbits(62), generation = 0))
+		session.commit()
+		row = session.execute(query).first()
+	return (row[0], row[1])
+
+class DHashStore:
+	#dhashes as packed little endian uint64 pairs in a flat file, with a parallel file of DHashData ids,
+	#so a whole library can be memory mapped and scanned without touching the database
+	SCAN_BLOCK = 1 << 22
+
+	def __init__(self, basePath: str, dhashSize: int = 8) -> None:
+		self.dhashSize = dhashSize
+		self.wordsPath = "{0}.dhash{1}.bin".format(basePath, dhashSize)
+		self.idsPath = "{0}.dhash{1}.ids".format(basePath, dhashSize)
+		self.metaPath = "{0}.dhash{1}.json".format(basePath, dhashSize)
+		self.meta = None
+		if os.path.isfile(self.metaPath):
+			try:
+				with open(self.metaPath, "r", encoding="utf8") as inFile:
+					self.meta = json.load(inFile)
+			except (OSError, ValueError):
+				self.meta = None
+
+	def getSignature(self) -> tuple:
+		return (self.dhashSize, self.meta['dbCount'], self.meta['maxId'], self.meta['token'], self.meta['generation'])
+
+	def writeRows(self, rows: list[tuple[int, str]], wordsFile, idsFile) -> int:
+		hexLen = self.dhashSize * self.dhashSize // 2
+		rows = [x for x in rows if x[1] and len(x[1]) == hexLen]
+		if rows:
+			wordsFile.write(parseDHashes([x[1] for x in rows]).astype('<u8').tobytes())
+			idsFile.write(np.array([x[0] for x in rows], dtype='<i8').tobytes())
+		return len(rows)
+
+	def saveMeta(self, meta: dict) -> None:
+		with open(self.metaPath, "w", encoding="utf8") as outFile:
+			json.dump(meta, outFile)
+		self.meta = meta
+
+	def sync(self, session: sqlalchemy.orm.Session) -> None:
+		dhashTable = DHashData.__table__
+		dbCount, dbMaxId = session.execute(
+			sqlalchemy.select(func.count(dhashTable.c.id), func.max(dhashTable.c.id))
+				.where(dhashTable.c.hashSize == self.dhashSize)
+		).first()
+		dbCount = dbCount or 0
+		dbMaxId = dbMaxId or 0
+		token, generation = getTableGeneration(session, dhashTable)
+		meta = self.meta
+		#files written by another database, or before rows were deleted or changed, can't be reused or appended to
+		if meta and (meta.get('token'), meta.get('generation')) != (token, generation):
+			meta = None
+		if meta and (meta['dbCount'], meta['maxId']) == (dbCount, dbMaxId) \
+				and os.path.isfile(self.wordsPath) and os.path.isfile(self.idsPath):
+			return
+
+		newQuery = sqlalchemy.select(dhashTable.c.id, dhashTable.c.dhash) \
+			.where(dhashTable.c.hashSize == self.dhashSize) \
+			.order_by(dhashTable.c.id)
+		batchSize = 100000
+		#rows only ever get appended unless something was deleted, in which case the counts stop adding up
+		canAppend = meta and (meta['maxId'] <= dbMaxId) \
+			and os.path.isfile(self.wordsPath) and os.path.isfile(self.idsPath) \
+			and (meta['dbCount'] + session.execute(
+				sqlalchemy.select(func.count(dhashTable.c.id))
+					.where(dhashTable.c.hashSize == self.dhashSize)
+					.where(dhashTable.c.id > meta['maxId'])
+			).scalar() == dbCount)
+		if canAppend:
+			print("appending {0} dhash(es) to {1}".format(dbCount - meta['dbCount'], self.wordsPath))
+			newQuery = newQuery.where(dhashTable.c.id > meta['maxId'])
+			numEntries = meta['entries']
+			wordsFile = open(self.wordsPath, "ab")
+			idsFile = open(self.idsPath, "ab")
+		else:
+			print("writing {0} dhash(es) to {1}".format(dbCount, self.wordsPath))
+			numEntries = 0
+			wordsFile = open(self.wordsPath + ".tmp", "wb")
+			idsFile = open(self.idsPath + ".tmp", "wb")
+
+		with wordsFile, idsFile:
+			rows = []
+			for row in session.execute(newQuery).yield_per(batchSize):
+				rows.append(tuple(row))
+				if len(rows) >= batchSize:
+					numEntries += self.writeRows(rows, wordsFile, idsFile)
+					rows = []
+			numEntries += self.writeRows(rows, wordsFile, idsFile)
+		if not canAppend:
+			os.replace(self.wordsPath + ".tmp", self.wordsPath)
+			os.replace(self.idsPath + ".tmp", self.idsPath)
+		self.saveMeta({'dhashSize': self.dhashSize, 'dbCount': dbCount, 'maxId': dbMaxId, 'entries': numEntries,
+			'token': token, 'generation': generation})
+
+	def load(self) -> tuple[np.ndarray, np.ndarray]:
+		numEntries = self.meta['entries'] if self.meta else 0
+		if not numEntries:
+			return (np.zeros(0, dtype='<i8'), np.zeros((0, 2), dtype='<u8'))
+		ids = np.memmap(self.idsPath, dtype='<i8', mode='r', shape=(numEntries,))
+		words = np.memmap(self.wordsPath, dtype='<u8', mode='r', shape=(numEntries, 2))
+		return (ids, words)
+
+	def scan(self, queryWord: np.ndarray, maxDist: int) -> tuple[np.ndarray, np.ndarray]:
+		#brute force over every stored hash, block by block so the mapped file is streamed rather than copied
+		ids, words = self.load()
+		queryWord = queryWord.reshape(2).astype('<u8')
+		foundIds = []
+		foundDistances = []
+		for blockStart in range(0, len(words), DHashStore.SCAN_BLOCK):
+			block = words[blockStart:blockStart + DHashStore.SCAN_BLOCK]
+			distances = popcount64(block[:, 0] ^ queryWord[0]).astype(np.int32) + popcount64(block[:, 1] ^ queryWord[1])
+			matched = np.flatnonzero(distances <= maxDist)
+			foundIds.append(np.asarray(ids[blockStart + matched]))
+			foundDistances.append(distances[matched])
+		if not foundIds:
+			return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+		return (np.concatenate(foundIds), np.concatenate(foundDistances))
+
+class DHashIndex:
+	#multi-index hashing: if two 128 bit hashes are within maxdist, at least one of the
+	#NUM_CHUNKS 16 bit chunks is within maxdist // NUM_CHUNKS of the other, so only those are compared
+	NUM_CHUNKS = 8
+	CHUNK_BITS = 16
+	QUERY_BATCH = 20000
+
+	def __init__(self, ids: np.ndarray, words: np.ndarray) -> None:
+		self.ids = ids
+		#identical dhashes share one entry, or blank and solid color images would make every chunk lookup huge
+		self.words, self.inverse = np.unique(words.reshape(-1, 2), axis=0, return_inverse=True)
+		self.inverse = self.inverse.reshape(-1)
+		self.rowOrder = np.argsort(self.inverse, kind='stable')
+		self.rowStarts = np.searchsorted(self.inverse[self.rowOrder], np.arange(len(self.words) + 1))
+
+		chunks = DHashIndex.getChunks(self.words)
+		self.chunkOrder = np.argsort(chunks, axis=0, kind='stable').T.copy()
+		self.sortedChunks = np.take_along_axis(chunks, self.chunkOrder.T, axis=0).T.copy()
+
+	def getChunks(words: np.ndarray) -> np.ndarray:
+		chunksPerWord = DHashIndex.NUM_CHUNKS // 2
+		chunks = np.empty((len(words), DHashIndex.NUM_CHUNKS), dtype=np.uint16)
+		for i in range(DHashIndex.NUM_CHUNKS):
+			shift = np.uint64(DHashIndex.CHUNK_BITS * (chunksPerWord - 1 - i % chunksPerWord))
+			chunks[:, i] = (words[:, i // chunksPerWord] >> shift) & np.uint64(0xFFFF)
+		return chunks
+
+	def getFlipMasks(radius: int) -> np.ndarray:
+		masks = [0]
+		for numBits in range(1, radius + 1):
+			masks.extend(sum(1 << x for x in bits) for bits in itertools.combinations(range(DHashIndex.CHUNK_BITS), numBits))
+		return np.array(masks, dtype=np.uint16)
+
+	def save(self, path: str, signature: tuple) -> None:
+		with open(path, 'wb') as outFile:
+			np.savez(outFile, signature=np.array(signature, dtype=np.int64), ids=self.ids, words=self.words, 
+				inverse=self.inverse, rowOrder=self.rowOrder, rowStarts=self.rowStarts,
+				chunkOrder=self.chunkOrder, sortedChunks=self.sortedChunks)
+
+	def load(path: str, signature: tuple):
+		if not os.path.isfile(path):
+			return None
+		try:
+			with np.load(path) as data:
+				if tuple(data['signature'].tolist()) != tuple(signature):
+					return None
+				result = DHashIndex.__new__(DHashIndex)
+				for key in ['ids', 'words', 'inverse', 'rowOrder', 'rowStarts', 'chunkOrder', 'sortedChunks']:
+					setattr(result, key, data[key])
+				return result
+		except (OSError, ValueError, KeyError) as e:
+			print("cannot load dhash index {0}: {1}".format(path, e))
+			return None
+
+	def getRows(self, entry: int) -> np.ndarray:
+		return self.rowOrder[self.rowStarts[entry]:self.rowStarts[entry + 1]]
+
+	def findPairs(self, queryWords: np.ndarray, maxDist: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+		#returns (query index, entry index, distance) for every entry within maxDist of a query
+		queryWords = queryWords.reshape(-1, 2)
+		flipMasks = DHashIndex.getFlipMasks(maxDist // DHashIndex.NUM_CHUNKS)
+		results = ([], [], [])
+		for batchStart in range(0, len(queryWords), DHashIndex.QUERY_BATCH):
+			batchWords = queryWords[batchStart:batchStart + DHashIndex.QUERY_BATCH]
+			batchChunks = DHashIndex.getChunks(batchWords)
+			candidates = []
+			for chunkIndex in range(DHashIndex.NUM_CHUNKS):
+				sortedChunks = self.sortedChunks[chunkIndex]
+				for flipMask in flipMasks:
+					probes = batchChunks[:, chunkIndex] ^ flipMask
+					left = np.searchsorted(sortedChunks, probes, 'left')
+					counts = np.searchsorted(sortedChunks, probes, 'right') - left
+					total = int(counts.sum())
+					if not total:
+						continue
+					queryIndices = np.repeat(np.arange(len(batchWords)), counts)
+					offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+					entryIndices = self.chunkOrder[chunkIndex][np.repeat(left, counts) + offsets]
+					candidates.append(queryIndices.astype(np.int64) * len(self.words) + entryIndices)
+			if not candidates:
+				continue
+			candidates = np.unique(np.concatenate(candidates))
+			queryIndices = candidates // len(self.words)
+			entryIndices = candidates % len(self.words)
+			distances = popcount64(batchWords[queryIndices, 0] ^ self.words[entryIndices, 0]).astype(np.int32) \
+				+ popcount64(batchWords[queryIndices, 1] ^ self.words[entryIndices, 1])
+			matched = distances <= maxDist
+			results[0].append(queryIndices[matched] + batchStart)
+			results[1].append(entryIndices[matched])
+			results[2].append(distances[matched])
+		if not results[0]:
+			empty = np.zeros(0, dtype=np.int64)
+			return (empty, empty, empty)
+		return tuple(np.concatenate(x) for x in results)
 
 """
 letterPalette = [
@@ -472,255 +889,1530 @@ letterPalette = [
 	('W', (0xff, 0xff, 0xff))
 ]
 
-def getPaletteString(path: str) -> str:
+def getPaletteString(path: str, workSize: int = 0) -> str:
 	with Image.open(path) as img:
-		palette = []
-		for x in letterPalette:
-			palette.extend(x[1])
-		palette = palette + [0]*(768 - len(palette))
-		
-		palImg = Image.new('P', (1, 1))
-		palImg.putpalette(palette)
-
-		convImg = None
-
-		#print("{0}: {1}".format(img.mode, path))
-		if (img.mode in ['L', 'LA', 'CMYK', '1', 'P', 'RGBA']):
-			tmpImg = img.convert('RGB')
-			convImg = tmpImg.quantize(colors=len(letterPalette), palette=palImg, dither=0)
-		else:
-			convImg = img.quantize(colors=len(letterPalette), palette=palImg, dither=0)
-		#convImg.show()
-		unique, counts = np.unique(convImg, return_counts=True)
-		total = sum(counts)
-		cutoff = total*2/100
-
-		zipped = zip_longest(unique, counts)
-		zipped = list(zipped)
-		if (len(zipped) > len(letterPalette)):
-			print("invalid palette: {0} (len zipped: {1}). MOde: {2}".format(path, len(zipped), img.mode))
-			#print(zipped, len(zipped))
-			raise Exception("Algorithm error")
-			
-		#print(list(zipped))
-		res = [(letterPalette[x[0]][0], x[1]) for x in zipped if x[1] > cutoff]
-
-		letterCounts = {}
-		for x in res:
-			letterCounts[x[0]] = letterCounts.get(x[0], 0) + x[1]
-
-		letters = list(letterCounts)
-		letters.sort(key = lambda x: letterCounts.get(x, 0), reverse=True)
-
-		result = "".join(letters)
-		return result
-		# print(letterCounts)
-		# res = "".join(c[0] for c in groupby(res))
-		# return res
-
-def makeFileData(scanFile: ScanFileData) -> FileData:
-	newData = FileData(
-		path = scanFile.path,
-		size = scanFile.size,
-		mtime = scanFile.mtime,
-		ctime = scanFile.ctime,
-
-		hash = getDigest(scanFile.path)
+		return getImagePaletteString(loadWorkImage(img, workSize))
+
+PALETTE_LEVELS = 6
+PALETTE_STEP = 0x33
+PALETTE_CUTOFF_PERCENT = 2
+
+def getCubeIndex(col: tuple[int, int, int]) -> int:
+	r, g, b = (x // PALETTE_STEP for x in col)
+	return (r * PALETTE_LEVELS + g) * PALETTE_LEVELS + b
+
+def makePaletteTables() -> tuple[list[int], str, np.ndarray]:
+	#PIL looks up palette colors by the top 6 bits of each channel, the same rounding keeps letters identical to Image.quantize
+	values = np.arange(256)
+	channelLevels = ((values & 0xFC) + PALETTE_STEP // 2) // PALETTE_STEP
+	#per band lookup for Image.point, bands pre-multiplied so their sum is the cube index
+	channelTable = np.concatenate((
+		channelLevels * PALETTE_LEVELS * PALETTE_LEVELS,
+		channelLevels * PALETTE_LEVELS,
+		channelLevels
+	)).tolist()
+
+	letters = ""
+	cubeLetters = np.zeros(PALETTE_LEVELS ** 3, dtype=np.intp)
+	for letter, col in letterPalette:
+		if letter not in letters:
+			letters += letter
+		cubeLetters[getCubeIndex(col)] = letters.index(letter)
+	return (channelTable, letters, cubeLetters)
+
+channelTable, paletteLetters, cubeLetters = makePaletteTables()
+letterMatrix = np.zeros((PALETTE_LEVELS ** 3, len(paletteLetters)), dtype=np.int64)
+letterMatrix[np.arange(PALETTE_LEVELS ** 3), cubeLetters] = 1
+letterArray = np.array(list(paletteLetters))
+
+def getImageHistogram(img: Image.Image) -> np.ndarray:
+	if (img.mode in ['L', 'LA', 'CMYK', '1', 'P', 'RGBA']):
+		img = img.convert('RGB')
+	elif img.mode != 'RGB':
+		raise ValueError("only RGB or L mode images can be quantized to a palette")
+	#table lookup and band sums run inside PIL, which beats indexing a numpy copy of every pixel
+	r, g, b = img.point(channelTable).split()
+	cubeIndices = ImageChops.add(ImageChops.add(r, g), b)
+	return np.array(cubeIndices.histogram()[:PALETTE_LEVELS ** 3], dtype=np.int64)
+
+def packHistogram(counts: np.ndarray) -> bytes:
+	return np.minimum(counts, 0xFFFFFFFF).astype('<u4').tobytes()
+
+def unpackHistograms(blobs: list[bytes]) -> np.ndarray:
+	return np.frombuffer(b"".join(blobs), dtype='<u4').reshape(-1, PALETTE_LEVELS ** 3)
+
+def getHistogramPaletteStrings(counts: np.ndarray) -> list[str]:
+	counts = np.asarray(counts, dtype=np.int64).reshape(-1, PALETTE_LEVELS ** 3)
+	numBins = counts.shape[1]
+	cutoff = counts.sum(axis=1)*PALETTE_CUTOFF_PERCENT/100
+	kept = counts > cutoff[:, None]
+	letterCounts = np.where(kept, counts, 0) @ letterMatrix
+	#ties keep the order in which letters first show up in the palette
+	cubeOrder = np.where(kept, np.arange(numBins), numBins)
+	firstSeen = np.stack([cubeOrder[:, cubeLetters == x].min(axis=1) for x in range(len(paletteLetters))], axis=1)
+	order = np.lexsort((firstSeen, -letterCounts), axis=-1)
+	present = np.take_along_axis(firstSeen < numBins, order, axis=1)
+	letters = letterArray[order]
+	return ["".join(row[mask]) for row, mask in zip(letters, present)]
+
+def getColorMask(colors: str) -> int:
+	#one bit per palette letter, anything that isn't a palette letter is ignored
+	colorMask = 0
+	for letter in colors.upper():
+		index = paletteLetters.find(letter)
+		if index >= 0:
+			colorMask |= 1 << index
+	return colorMask
+
+def getPaletteColors(palString: str) -> dict:
+	return {
+		'palette': palString,
+		'colorMask': getColorMask(palString),
+		'mainColor': palString[:1]
+	}
+
+def getHistogramPaletteString(counts: np.ndarray) -> str:
+	return getHistogramPaletteStrings(counts)[0]
+
+def getImagePaletteString(img: Image.Image) -> str:
+	return getHistogramPaletteString(getImageHistogram(img))
+
+def listDirectory(config: Config, dirPath: str) \
+		-> tuple[list[str], list[tuple[str, os.stat_result]]]:
+	subDirs = []
+	files = []
+	with os.scandir(dirPath) as entries:
+		for entry in entries:
+			try:
+				if entry.is_dir():
+					if not entry.is_symlink():
+						subDirs.append(entry.path)
+					continue
+				if not config.isSupportedExt(entry.name):
+					continue
+				files.append((entry.path, entry.stat()))
+			except OSError as e:
+				print("File {0} not found: {1}".format(entry.path, e))
+	return (subDirs, files)
+
+def getScanData(fileStat: os.stat_result) -> tuple[int, datetime, datetime]:
+	return (
+		fileStat.st_size,
+		datetime.fromtimestamp(fileStat.st_ctime),
+		datetime.fromtimestamp(fileStat.st_mtime)
 	)
-	return newData
 
-def makeHashData(fileData: FileData) -> tuple[str, FileData]:
+def getFileIdentity(fileStat: os.stat_result) -> tuple[Optional[int], Optional[int]]:
+	#0 means unknown (DirEntry.stat() on windows), ids past 2^63 are wrapped to fit sqlite's signed integers
+	if not fileStat.st_ino:
+		return (None, None)
+	return tuple(x - (1 << 64) if x >= (1 << 63) else x for x in (fileStat.st_ino, fileStat.st_dev))
+
+def walkDirectories(config: Config, rootPath: str):
+	dirStack = [rootPath]
+	while dirStack:
+		curDir = dirStack.pop()
+		if config.isExcludedPath(curDir):
+			continue
+		yield curDir
+		try:
+			with os.scandir(curDir) as entries:
+				for entry in entries:
+					if entry.is_dir(follow_symlinks=False):
+						dirStack.append(entry.path)
+		except OSError as e:
+			print("cannot list {0}: {1}".format(curDir, e))
+
+class InotifyWatcher:
+	IN_MODIFY = 0x00000002
+	IN_ATTRIB = 0x00000004
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF = 0x00000800
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_ISDIR = 0x40000000
+	IN_CLOEXEC = 0o2000000
+
+	WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+		| IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+	EVENT_HEADER = struct.Struct('iIII')
+
+	def isAvailable() -> bool:
+		if not sys.platform.startswith('linux'):
+			return False
+		libcName = ctypes.util.find_library('c')
+		if not libcName:
+			return False
+		libc = ctypes.CDLL(libcName, use_errno=True)
+		return hasattr(libc, 'inotify_init1')
+
+	def __init__(self) -> None:
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		self.watches: dict[int, str] = {}
+		self.watchIds: dict[str, int] = {}
+
+	def close(self) -> None:
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+	def addWatch(self, path: str) -> None:
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), InotifyWatcher.WATCH_MASK)
+		if wd < 0:
+			err = ctypes.get_errno()
+			if err in (errno.ENOENT, errno.ENOTDIR):
+				return
+			raise OSError(err, "{0}: {1}".format(os.strerror(err), path))
+		self.watches[wd] = path
+		self.watchIds[path] = wd
+
+	def removeTree(self, path: str) -> None:
+		prefix = os.path.join(path, '')
+		for curPath in [x for x in self.watchIds if (x == path) or x.startswith(prefix)]:
+			wd = self.watchIds.pop(curPath)
+			self.watches.pop(wd, None)
+			self.libc.inotify_rm_watch(self.fd, wd)
+
+	def readEvents(self, timeout: float) -> Optional[list[tuple[int, str]]]:
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if not ready:
+			return []
+		data = os.read(self.fd, 1024 * 1024)
+		events = []
+		offset = 0
+		headerSize = InotifyWatcher.EVENT_HEADER.size
+		while offset + headerSize <= len(data):
+			wd, mask, cookie, nameLen = InotifyWatcher.EVENT_HEADER.unpack_from(data, offset)
+			offset += headerSize
+			name = data[offset:offset + nameLen].rstrip(b'\0')
+			offset += nameLen
+			if mask & InotifyWatcher.IN_Q_OVERFLOW:
+				return None
+			if mask & InotifyWatcher.IN_IGNORED:
+				dirPath = self.watches.pop(wd, None)
+				if dirPath is not None and self.watchIds.get(dirPath) == wd:
+					del self.watchIds[dirPath]
+				continue
+			dirPath = self.watches.get(wd)
+			if dirPath is None:
+				continue
+			path = os.path.join(dirPath, os.fsdecode(name)) if name else dirPath
+			events.append((mask, path))
+		return events
+
+def makeHashData(data: tuple[tuple[int, str, int], bool]) \
+		-> tuple[tuple[int, str, int], Optional[str], Optional[Exception], dict[str, float]]:
 	try:
-		return (fileData, getDigest(fileData.path))
+		fileData = data[0]
+		useMmap = data[1]
+		startTime = time.monotonic()
+		digest = getDigest(fileData[1], useMmap)
+		return (fileData, digest, None, {'hash': time.monotonic() - startTime})
 	except KeyboardInterrupt:
 		return None
+	except Exception as e:
+		return (fileData, None, e, {})
 
-def makeDHashData(data: tuple[FileData, int]) -> tuple[DHashData, str]:
+def makeDHashData(data: tuple[tuple[str, int, str], int, int]) \
+		-> tuple[Optional[dict], tuple[str, int, str], Optional[Exception], dict[str, float]]:
 	try:
 		fileData = data[0]
 		dhashSize = data[1]
-		imgHash = getDHash(fileData.path, dhashSize)
-		newData = DHashData(
-			hash = fileData.hash,
-			size = fileData.size,
-			hashSize = dhashSize,
-			dhash = imgHash
-		)
-		return (newData, fileData.path)
+		workSize = data[2]
+		startTime = time.monotonic()
+		with Image.open(fileData[0]) as img:
+			workImg = loadWorkImage(img, workSize)
+			decodeTime = time.monotonic() - startTime
+			imgHash = getImageDHash(workImg, dhashSize)
+		times = {'decode': decodeTime, 'compute': time.monotonic() - startTime - decodeTime}
+		newData = {
+			'hash': fileData[2],
+			'size': fileData[1],
+			'hashSize': dhashSize,
+			'dhash': imgHash
+		}
+		return (newData, fileData, None, times)
 	except KeyboardInterrupt:
 		return None
+	except Exception as e:
+		return (None, fileData, e, {})
+
+#formats tesseract (leptonica) reads by itself, anything else goes through a temporary png
+TESS_NATIVE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif', '.webp', '.pnm', '.pbm', '.pgm', '.ppm']
+TESS_PAGE_SEPARATOR = '\f'
+
+def getTessArgs(tessCmd) -> list[str]:
+	return list(tessCmd) if isinstance(tessCmd, (list, tuple)) else [tessCmd]
+
+def runTesseractList(tessCmd, imagePaths: list[str], ocrLang: str, tempDir: str, timeout: Optional[float] = None) -> list[str]:
+	#one tesseract process for the whole list, so the language model is loaded once. Pages come back separated by form feeds
+	inputPath = imagePaths[0]
+	if len(imagePaths) > 1:
+		inputPath = os.path.join(tempDir, "images.txt")
+		with open(inputPath, "w", encoding="utf8") as listFile:
+			for imagePath in imagePaths:
+				listFile.write(os.path.abspath(imagePath))
+				listFile.write("\n")
+	result = subprocess.run(getTessArgs(tessCmd) + [inputPath, "stdout", "-l", ocrLang],
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+	if result.returncode != 0:
+		raise RuntimeError("tesseract failed ({0}): {1}".format(result.returncode, result.stderr.decode("utf8", "replace").strip()))
+	pages = result.stdout.decode("utf8", "replace").split(TESS_PAGE_SEPARATOR)
+	if pages and not pages[-1].strip():
+		pages.pop()
+	if len(pages) != len(imagePaths):
+		raise RuntimeError("tesseract returned {0} page(s) for {1} image(s)".format(len(pages), len(imagePaths)))
+	#same text as one image_to_string call per image
+	return [x + TESS_PAGE_SEPARATOR for x in pages]
+
+OCR_STATUS_SKIPPED = 'skipped'
+OCR_STATUS_TIMEOUT = 'timeout'
+OCR_STATUS_TOO_LARGE = 'toolarge'
+OCR_RETRY_STATUSES = [OCR_STATUS_SKIPPED, OCR_STATUS_TIMEOUT, OCR_STATUS_TOO_LARGE]
+#PIL refuses to open anything over twice its MAX_IMAGE_PIXELS (~178 MP) as a decompression bomb. Scans get that big, and are scaled down before tesseract sees them
+OCR_MAX_OPEN_PIXELS = 1 << 30
+#a batch gets the timeout of one image plus this much per image, so one stuck image can't hold a worker for timeout * batch size
+OCR_BATCH_SECONDS_PER_IMAGE = 15.0
+
+def getOcrBatchTimeout(timeout: float, numImages: int) -> Optional[float]:
+	if timeout <= 0:
+		return None
+	return min(timeout * numImages, timeout + OCR_BATCH_SECONDS_PER_IMAGE * numImages)
+
+def allowLargeOcrImages() -> Optional[int]:
+	#returns the previous limit. Process wide, so set while the ocr pool runs rather than per image
+	prevLimit = Image.MAX_IMAGE_PIXELS
+	if (prevLimit is not None) and (prevLimit < OCR_MAX_OPEN_PIXELS):
+		Image.MAX_IMAGE_PIXELS = OCR_MAX_OPEN_PIXELS
+	return prevLimit
+
+def getOcrScale(img: Image.Image, maxPixels: int, maxDpi: int) -> float:
+	#huge scans take tesseract minutes and gigabytes, and text stays readable well below their resolution
+	scale = 1.0
+	numPixels = img.size[0] * img.size[1]
+	if (maxPixels > 0) and (numPixels > maxPixels):
+		scale = (maxPixels / numPixels) ** 0.5
+	dpi = img.info.get('dpi')
+	try:
+		dpi = float(max(dpi)) if dpi else 0.0
+	except (TypeError, ValueError):
+		dpi = 0.0
+	if (maxDpi > 0) and (dpi > maxDpi):
+		scale = min(scale, maxDpi / dpi)
+	return scale
+
+def getOcrSize(size: tuple[int, int], scale: float) -> Optional[tuple[int, int]]:
+	#None when the image goes to tesseract as it is
+	if scale >= 1.0:
+		return None
+	return (max(int(size[0] * scale), 1), max(int(size[1] * scale), 1))
+
+def prepareOcrImage(img: Image.Image, ocrSize: Optional[tuple[int, int]], scale: float) -> Image.Image:
+	#ocrSize and scale are relative to the full image, img may have been drafted smaller already
+	if ocrSize is None:
+		return img
+	dpi = img.info.get('dpi')
+	if img.mode not in ('1', 'L', 'RGB', 'RGBA'):
+		img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+	#reduce() by whole factors first, resizing straight from a big image keeps a full height copy between its two passes.
+	#A jpeg drafted to the right size needs neither
+	result = img
+	factor = min(img.size[0] // ocrSize[0], img.size[1] // ocrSize[1])
+	if (factor >= 2) and (img.mode != '1'):
+		result = result.reduce(factor)
+	if result.size != ocrSize:
+		result = result.resize(ocrSize, Image.LANCZOS)
+	if dpi:
+		try:
+			result.info['dpi'] = tuple(x * scale for x in dpi)
+		except TypeError:
+			pass
+	return result
+
+TEXT_WORK_SIZE = 800
+TEXT_MAX_REDUCE = 4
+TEXT_BLOCK = 16
+TEXT_EDGE_THRESHOLD = 40
+TEXT_BLOCK_DENSITY = 0.08
+
+def getTextBlockCount(img: Image.Image, fullSize: Optional[tuple[int, int]] = None) -> int:
+	#text is strong edges in both directions packed closely together. Smooth photos and flat areas have few of those,
+	#so counting 16x16 blocks dense in both tells images that may have text from ones that almost certainly don't
+	#big scans are only shrunk so far, past that their text blurs into grey. fullSize is the size before any draft
+	fullSize = fullSize or img.size
+	factor = min(-(-max(fullSize) // TEXT_WORK_SIZE), TEXT_MAX_REDUCE)
+	workSize = (max(fullSize[0] // factor, 1), max(fullSize[1] // factor, 1))
+	img.draft(None, workSize)
+	#shrunk before converting, so there is no full size grey copy
+	gray = reduceImage(img, min(workSize)).convert('L')
+	if gray.size != workSize:
+		gray = gray.resize(workSize, Image.BOX)
+	pixels = np.asarray(gray, dtype=np.int16)
+	rows = (pixels.shape[0] - 1) // TEXT_BLOCK * TEXT_BLOCK
+	cols = (pixels.shape[1] - 1) // TEXT_BLOCK * TEXT_BLOCK
+	if (rows <= 0) or (cols <= 0):
+		return 0
+	dx = np.abs(pixels[:rows, 1:cols + 1] - pixels[:rows, :cols]) > TEXT_EDGE_THRESHOLD
+	dy = np.abs(pixels[1:rows + 1, :cols] - pixels[:rows, :cols]) > TEXT_EDGE_THRESHOLD
+	blockShape = (rows // TEXT_BLOCK, TEXT_BLOCK, cols // TEXT_BLOCK, TEXT_BLOCK)
+	dxDensity = dx.reshape(blockShape).mean(axis=(1, 3))
+	dyDensity = dy.reshape(blockShape).mean(axis=(1, 3))
+	return int(np.count_nonzero((dxDensity > TEXT_BLOCK_DENSITY) & (dyDensity > TEXT_BLOCK_DENSITY)))
+
+def isTextUnlikely(img: Image.Image, minTextBlocks: int, fullSize: Optional[tuple[int, int]] = None) -> bool:
+	if minTextBlocks <= 0:
+		return False
+	try:
+		return getTextBlockCount(img, fullSize) < minTextBlocks
+	except Exception:
+		#when in doubt, ocr it
+		return False
+
+def getOcrDraftSize(size: tuple[int, int], ocrSize: Optional[tuple[int, int]], minTextBlocks: int) -> tuple[int, int]:
+	#smallest decode the text check and the ocr image can both still be made from. Only jpeg can decode at a smaller size,
+	#other formats are decoded in full once and shrunk from there
+	draftSize = ocrSize or size
+	if minTextBlocks > 0:
+		draftSize = (max(draftSize[0], -(-size[0] // TEXT_MAX_REDUCE)), max(draftSize[1], -(-size[1] // TEXT_MAX_REDUCE)))
+	return draftSize
 
-def makeOcrData(data: tuple[tuple[str, int, str], str, str, bool]) \
-		-> tuple[Optional[tuple[str, str]], tuple[str, int, str], Optional[Exception]]:
+def makeOcrBatch(data: tuple[int, list[tuple[str, int, str]], str, str, int, tuple[float, int, int]]) \
+		-> Optional[tuple[int, list[tuple[Optional[dict], tuple[str, int, str], Optional[Exception]]]]]:
+	try:
+		batchIndex = data[0]
+		batch = data[1]
+		tessCmd = data[2]
+		ocrLang = data[3]
+		minTextBlocks = data[4]
+		timeout, maxPixels, maxDpi = data[5]
+		results = {}
+		with tempfile.TemporaryDirectory(prefix="imgdbocr") as tempDir:
+			imagePaths = []
+			listed = []
+			filterTimes = {}
+
+			def makeResult(index, page, status, ocrTime):
+				return ({'text': page, 'lang': ocrLang, 'status': status,
+					'ocrTime': ocrTime, 'filterTime': filterTimes.get(index, 0.0)}, batch[index], None)
+
+			for index, fileData in enumerate(batch):
+				filePath = fileData[0]
+				try:
+					startTime = time.monotonic()
+					#opened and decoded once for the text check and the ocr image. Nothing is decoded for an image
+					#that goes to tesseract as it is without a text check
+					with Image.open(filePath) as img:
+						fullSize = img.size
+						scale = getOcrScale(img, maxPixels, maxDpi)
+						ocrSize = getOcrSize(fullSize, scale)
+						img.draft(None, getOcrDraftSize(fullSize, ocrSize, minTextBlocks))
+						skipped = isTextUnlikely(img, minTextBlocks, fullSize)
+						filterTimes[index] = time.monotonic() - startTime
+						if skipped:
+							results[index] = makeResult(index, "", OCR_STATUS_SKIPPED, 0.0)
+							continue
+						if (ocrSize is None) and (os.path.splitext(filePath)[1].lower() in TESS_NATIVE_EXTENSIONS):
+							imagePaths.append(filePath)
+							listed.append(index)
+							continue
+						tempPath = os.path.join(tempDir, "{0}.png".format(index))
+						ocrImg = prepareOcrImage(img, ocrSize, scale)
+						saveArgs = {'dpi': ocrImg.info['dpi']} if ocrImg.info.get('dpi') else {}
+						ocrImg.save(tempPath, **saveArgs)
+					imagePaths.append(tempPath)
+					listed.append(index)
+				except Image.DecompressionBombError:
+					results[index] = makeResult(index, "", OCR_STATUS_TOO_LARGE, 0.0)
+				except Exception as e:
+					results[index] = (None, fileData, e)
+
+			if imagePaths:
+				try:
+					startTime = time.monotonic()
+					pages = runTesseractList(tessCmd, imagePaths, ocrLang, tempDir, getOcrBatchTimeout(timeout, len(imagePaths)))
+					ocrTime = (time.monotonic() - startTime) / len(pages)
+					for index, page in zip(listed, pages):
+						results[index] = makeResult(index, page, None, ocrTime)
+				except (RuntimeError, OSError, subprocess.TimeoutExpired) as e:
+					#a multi page tiff, a broken file or one slow image spoils the batch, one image at a time sorts that out
+					print("batch ocr failed, retrying images one by one: {0}".format(e))
+					for index, imagePath in zip(listed, imagePaths):
+						startTime = time.monotonic()
+						try:
+							page = runTesseractList(tessCmd, [imagePath], ocrLang, tempDir, timeout if timeout > 0 else None)[0]
+							results[index] = makeResult(index, page, None, time.monotonic() - startTime)
+						except subprocess.TimeoutExpired:
+							results[index] = makeResult(index, "", OCR_STATUS_TIMEOUT, time.monotonic() - startTime)
+						except (RuntimeError, OSError) as e:
+							results[index] = (None, batch[index], e)
+		return (batchIndex, [results[x] for x in range(len(batch))])
+	except KeyboardInterrupt:
+		return None
+
+def makePaletteData(data: tuple[tuple[str, int, str], int]) \
+		-> tuple[Optional[dict], str, Optional[Exception], dict[str, float]]:
 	try:
 		fileData = data[0]
-		tessCmd = data[1]
-		ocrLang = data[2]
-		useFullData = data[3]
+		workSize = data[1]
+		startTime = time.monotonic()
+		with Image.open(fileData[0]) as img:
+			workImg = loadWorkImage(img, workSize)
+			decodeTime = time.monotonic() - startTime
+			counts = getImageHistogram(workImg)
+		palString = getHistogramPaletteString(counts)
+		times = {'decode': decodeTime, 'compute': time.monotonic() - startTime - decodeTime}
+		#print(palString)
+		newData = {
+			'size': fileData[1],
+			'hash': fileData[2],
+			'histogram': packHistogram(counts),
+			**getPaletteColors(palString)
+		}
+		return (newData, fileData[0], None, times)
+	except KeyboardInterrupt:
+		return None
+	except Exception as e:
+		return (None, fileData[0], e, {})
+
+JSONL_FILES = 'files'
+JSONL_PAL = 'pal'
+JSONL_DHASH = 'dhash'
+JSONL_OCR = 'ocr'
+JSONL_EXTENSIONS = ['.jsonl', '.ndjson']
+
+def isStreamJsonPath(filepath: str) -> bool:
+	return os.path.splitext(filepath)[1].lower() in JSONL_EXTENSIONS
+
+def encodeJsonBlob(value: Optional[bytes]) -> Optional[str]:
+	return None if value is None else base64.b64encode(value).decode("ascii")
+
+def decodeJsonBlob(value: Optional[str]) -> Optional[bytes]:
+	return None if value is None else base64.b64decode(value)
+
+def getJsonField(record: list, index: int):
+	#fields added later are missing from older exports
+	return record[index] if len(record) > index else None
+
+SNAPSHOT_MAGIC = b"IMGDBSNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_CHUNK_ROWS = 100000
+SNAPSHOT_NULL_INT = -(1 << 63)
+#per table: columns and how they're packed. hex columns become raw bytes, so a sha256 takes 32 bytes instead of 64 characters.
+#rows keep their ids, tables other than files point at a file with the same hash through fileRef and only store the hash when there is none
+SNAPSHOT_TABLES = {
+	'files': [('id', 'int'), ('path', 'str'), ('hash', 'hex'), ('size', 'int'), ('ctime', 'time'), ('mtime', 'time'),
+		('inode', 'int'), ('device', 'int')],
+	'dhashes': [('id', 'int'), ('fileRef', 'int'), ('hash', 'hex'), ('size', 'int'), ('hashSize', 'int'), ('dhash', 'hex')],
+	'palettes': [('id', 'int'), ('fileRef', 'int'), ('hash', 'hex'), ('size', 'int'), ('palette', 'str'), ('histogram', 'blob')],
+	'ocr': [('id', 'int'), ('fileRef', 'int'), ('hash', 'hex'), ('size', 'int'), ('lang', 'str'), ('text', 'str'), ('status', 'str')]
+}
+SNAPSHOT_OPTIONAL = ['histogram']
+
+def packSnapshotStrings(values: list) -> bytes:
+	#lengths first, then all the utf8 data. None gets 0xFFFFFFFF for a length
+	encoded = [x.encode("utf8") if isinstance(x, str) else x for x in values]
+	lengths = np.array([0xFFFFFFFF if x is None else len(x) for x in encoded], dtype='<u4')
+	return lengths.tobytes() + b"".join(x for x in encoded if x is not None)
+
+def unpackSnapshotStrings(data: bytes, numRows: int, decode: bool) -> list:
+	lengths = np.frombuffer(data, dtype='<u4', count=numRows).tolist()
+	offset = numRows * 4
+	result = []
+	for length in lengths:
+		if length == 0xFFFFFFFF:
+			result.append(None)
+			continue
+		value = data[offset:offset + length]
+		offset += length
+		result.append(value.decode("utf8") if decode else value)
+	return result
+
+def packSnapshotColumn(kind: str, values: list) -> tuple[dict, bytes]:
+	meta = {'kind': kind}
+	if kind == 'hex':
+		width = max((len(x) for x in values if x), default=0)
+		try:
+			if width % 2 or any(x and len(x) != width for x in values):
+				raise ValueError()
+			present = np.array([1 if x else 0 for x in values], dtype=np.uint8)
+			data = present.tobytes() + bytes.fromhex("".join(x if x else "0" * width for x in values))
+			meta['width'] = width // 2
+		except (ValueError, TypeError):
+			#not all the same length hex, keep them as text
+			meta['kind'] = 'str'
+			data = packSnapshotStrings(values)
+	elif kind in ('int', 'time'):
+		if kind == 'time':
+			values = [None if x is None else round(x.timestamp() * 1000000) for x in values]
+		data = np.array([SNAPSHOT_NULL_INT if x is None else x for x in values], dtype='<i8').tobytes()
+	else:
+		data = packSnapshotStrings(values)
+	return (meta, data)
+
+def unpackSnapshotColumn(meta: dict, data: bytes, numRows: int) -> list:
+	kind = meta['kind']
+	if kind == 'hex':
+		width = meta['width']
+		present = np.frombuffer(data, dtype=np.uint8, count=numRows).tolist()
+		digests = data[numRows:]
+		return [digests[i * width:(i + 1) * width].hex() if x else DEFAULT_HASH for i, x in enumerate(present)]
+	if kind in ('int', 'time'):
+		values = np.frombuffer(data, dtype='<i8', count=numRows).tolist()
+		if kind == 'time':
+			return [None if x == SNAPSHOT_NULL_INT else datetime.fromtimestamp(x / 1000000) for x in values]
+		return [None if x == SNAPSHOT_NULL_INT else x for x in values]
+	return unpackSnapshotStrings(data, numRows, kind == 'str')
+
+ANALYZE_DHASH = 'dhash'
+ANALYZE_PAL = 'pal'
+ANALYZE_OCR = 'ocr'
+ANALYZE_ARTIFACTS = [ANALYZE_DHASH, ANALYZE_PAL, ANALYZE_OCR]
+
+def checkAnalyzeArtifacts(artifacts: list[str]) -> None:
+	unknown = [x for x in artifacts if x not in ANALYZE_ARTIFACTS]
+	if unknown:
+		raise ValueError("unknown artifact(s) {0}, expected any of {1}".format(", ".join(unknown), ", ".join(ANALYZE_ARTIFACTS)))
+
+def parseAnalyzeArtifacts(value: str) -> list[str]:
+	artifacts = [x.strip() for x in value.split(',') if x.strip()]
+	try:
+		checkAnalyzeArtifacts(artifacts)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
+	return artifacts
+
+def makeAnalysisData(data: tuple[tuple[str, int, str], list[str], int, str, str, int, int, tuple[float, int, int]]) \
+		-> tuple[dict[str, dict], tuple[str, int, str], list[tuple[str, Exception]], dict[str, float]]:
+	try:
+		fileData = data[0]
+		artifacts = data[1]
+		dhashSize = data[2]
+		tessCmd = data[3]
+		ocrLang = data[4]
+		workSize = data[5]
+		minTextBlocks = data[6]
+		timeout, maxPixels, maxDpi = data[7]
 
 		filePath = fileData[0]
 		fileSize = fileData[1]
 		fileHash = fileData[2]
 
+		results = {}
+		errors = []
+		times = {}
+		if ANALYZE_OCR in artifacts:
+			#pool process, gone when the stage is done
+			allowLargeOcrImages()
+		startTime = time.monotonic()
 		with Image.open(filePath) as img:
-			pytesseract.pytesseract.tesseract_cmd = tessCmd
-			ocr = pytesseract.image_to_data(img, lang=ocrLang) if useFullData else pytesseract.image_to_string(img, lang=ocrLang) 
-			# newData = OcrData(
-			# 	size = fileData.size,
-			# 	hash = fileData.hash,
-			# 	lang = ocrLang,
-			# 	text = ocr
-			# )
-			return ((ocr, ocrLang), fileData, None)
+			#decode once, every artifact below works from the same pixels
+			if ANALYZE_OCR in artifacts:
+				fullSize = img.size
+				ocrScale = getOcrScale(img, maxPixels, maxDpi)
+				ocrSize = getOcrSize(fullSize, ocrScale)
+				draftSize = getOcrDraftSize(fullSize, ocrSize, minTextBlocks)
+				if [x for x in artifacts if x != ANALYZE_OCR]:
+					#dhash and palette need workSize, or everything
+					draftSize = (max(draftSize[0], workSize), max(draftSize[1], workSize)) if workSize > 0 else fullSize
+				img.draft(None, draftSize)
+				img.load()
+				workImg = reduceImage(img, workSize)
+			else:
+				workImg = loadWorkImage(img, workSize)
+			times['decode'] = time.monotonic() - startTime
+			startTime = time.monotonic()
+			if ANALYZE_DHASH in artifacts:
+				try:
+					results[ANALYZE_DHASH] = {
+						'hash': fileHash,
+						'size': fileSize,
+						'hashSize': dhashSize,
+						'dhash': getImageDHash(workImg, dhashSize)
+					}
+				except Exception as e:
+					errors.append((ANALYZE_DHASH, e))
+			if ANALYZE_PAL in artifacts:
+				try:
+					counts = getImageHistogram(workImg)
+					results[ANALYZE_PAL] = {
+						'hash': fileHash,
+						'size': fileSize,
+						'histogram': packHistogram(counts),
+						**getPaletteColors(getHistogramPaletteString(counts))
+					}
+				except Exception as e:
+					errors.append((ANALYZE_PAL, e))
+			times['compute'] = time.monotonic() - startTime
+			startTime = time.monotonic()
+			if ANALYZE_OCR in artifacts:
+				try:
+					ocrText = ""
+					ocrStatus = None
+					if isTextUnlikely(img, minTextBlocks, fullSize):
+						ocrStatus = OCR_STATUS_SKIPPED
+					else:
+						pytesseract.pytesseract.tesseract_cmd = tessCmd
+						ocrImg = prepareOcrImage(img, ocrSize, ocrScale)
+						try:
+							ocrText = pytesseract.image_to_string(ocrImg, lang=ocrLang, timeout=timeout)
+						except RuntimeError as e:
+							#pytesseract kills the process and raises this on timeout
+							if 'timeout' not in str(e).lower():
+								raise
+							ocrStatus = OCR_STATUS_TIMEOUT
+					results[ANALYZE_OCR] = {
+						'hash': fileHash,
+						'size': fileSize,
+						'lang': ocrLang,
+						'text': ocrText,
+						'status': ocrStatus
+					}
+				except Exception as e:
+					errors.append((ANALYZE_OCR, e))
+				times['ocr'] = time.monotonic() - startTime
+		return (results, fileData, errors, times)
 	except KeyboardInterrupt:
 		return None
+	except Image.DecompressionBombError as e:
+		#recorded for ocr so it isn't retried every run, dhash and palette have no such status
+		results = {}
+		if ANALYZE_OCR in artifacts:
+			results[ANALYZE_OCR] = {'hash': fileHash, 'size': fileSize, 'lang': ocrLang, 'text': "", 'status': OCR_STATUS_TOO_LARGE}
+		return (results, fileData, [('open', e)] if [x for x in artifacts if x != ANALYZE_OCR] else [], {})
 	except Exception as e:
-		return (None, fileData, e)
+		return ({}, fileData, [('open', e)], {})
+
+def makePaletteDataBatch(batch: list[tuple[tuple[str, int, str], int]]) \
+		-> Optional[list[tuple[Optional[dict], str, Optional[Exception], dict[str, float]]]]:
+	results = []
+	for data in batch:
+		curData = makePaletteData(data)
+		if curData is None:
+			return None
+		results.append(curData)
+	return results
+
+def makeBatches(items, batchSize: int):
+	batch = []
+	for item in items:
+		batch.append(item)
+		if len(batch) >= batchSize:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+STAGE_SCAN = 'scan'
+STAGE_HASH = 'hash'
+STAGE_DHASH = 'dhash'
+STAGE_PAL = 'pal'
+STAGE_OCR = 'ocr'
+STAGE_ANALYZE = 'analyze'
+STAGE_NAMES = [STAGE_SCAN, STAGE_HASH, STAGE_DHASH, STAGE_PAL, STAGE_OCR, STAGE_ANALYZE]
+
+class StageMetrics:
+	def __init__(self, stage: str, progressSeconds: float) -> None:
+		self.stage = stage
+		self.progressSeconds = progressSeconds
+		self.total = 0
+		self.numWorkers = 1
+		self.counters: dict[str, int] = {'files': 0, 'bytes': 0, 'errors': 0}
+		#timers spent in this process (db writes, waiting for workers) and summed over all workers (decode, compute)
+		self.timers: dict[str, float] = {}
+		self.workerTimers: dict[str, float] = {}
+		self.startTime = time.monotonic()
+		self.endTime = None
+		self.lastProgress = self.startTime
+
+	def count(self, name: str, amount: int = 1) -> None:
+		self.counters[name] = self.counters.get(name, 0) + amount
+
+	def addTime(self, name: str, seconds: float) -> None:
+		self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+	def addWorkerTimes(self, times: Optional[dict[str, float]]) -> None:
+		for name, seconds in (times or {}).items():
+			self.workerTimers[name] = self.workerTimers.get(name, 0.0) + seconds
+
+	@contextlib.contextmanager
+	def timer(self, name: str):
+		startTime = time.monotonic()
+		try:
+			yield
+		finally:
+			self.addTime(name, time.monotonic() - startTime)
+
+	def wait(self, results):
+		#time blocked on the pool is time the workers are the bottleneck
+		results = iter(results)
+		while True:
+			startTime = time.monotonic()
+			try:
+				result = next(results)
+			except StopIteration:
+				return
+			finally:
+				self.addTime('wait', time.monotonic() - startTime)
+			yield result
 
-def makePaletteData(fileData: FileData) \
-		-> tuple[Optional[PaletteData], str, Optional[Exception]]:
-	try:
-		palString = getPaletteString(fileData.path)
-		#print(palString)
-		newData = PaletteData(
-			size = fileData.size,
-			hash = fileData.hash,
-			palette = palString
-		)
-		#print(newData)
-		return (newData, fileData.path, None)
-	except KeyboardInterrupt:
-		return None
-	except Exception as e:
-		return (None, fileData.path, e)
+	def getElapsed(self) -> float:
+		return max((self.endTime or time.monotonic()) - self.startTime, 1e-6)
 
-class DbProcessor:
-	def scanFilesystem(self):
-		self.session.query(ScanFileData).delete()
-		print("scanning filesystem")
-		for curPath in self.config.paths:
-			for root, dirs, files in os.walk(curPath, topdown=True):
-				if self.config.isExcludedPath(root):
-					continue
-				for curFile in files:
-					curFilePath = os.path.join(root, curFile)
-					if not self.config.isSupportedExt(curFilePath):
-						continue
-					print("scanning: {0}".format(curFilePath))
-					fileObj = Path(curFilePath)
-					if not fileObj.exists:
-						print("File {0} not found".format(curFilePath))
-						continue
-					fileStat = fileObj.stat()
+	def getWorkerIdle(self) -> float:
+		return max(self.numWorkers * self.getElapsed() - sum(self.workerTimers.values()), 0.0)
 
-					scanData = ScanFileData(
-						path = curFilePath,
-						size = fileStat.st_size,
-						ctime = datetime.fromtimestamp(fileStat.st_ctime),
-						mtime = datetime.fromtimestamp(fileStat.st_mtime)
-					)
-					self.session.add(scanData)
+	def progress(self, force: bool = False) -> None:
+		now = time.monotonic()
+		if not force and (now - self.lastProgress) < self.progressSeconds:
+			return
+		self.lastProgress = now
+		elapsed = self.getElapsed()
+		numFiles = self.counters['files']
+		line = "{0}: {1}{2} files, {3:.1f} files/s, {4:.1f} MB/s".format(
+			self.stage, numFiles, "/{0}".format(self.total) if self.total else "",
+			numFiles / elapsed, self.counters['bytes'] / elapsed / (1024 * 1024))
+		if self.total and numFiles and (numFiles < self.total):
+			line += ", {0:.0f}s left".format(elapsed / numFiles * (self.total - numFiles))
+		if self.counters['errors']:
+			line += ", {0} error(s)".format(self.counters['errors'])
+		print(line, flush=True)
+
+	def finish(self) -> None:
+		if self.endTime is not None:
+			return
+		self.endTime = time.monotonic()
+		self.progress(True)
+		times = ["{0} {1:.1f}s".format(name, seconds) for name, seconds in sorted(self.timers.items())]
+		times += ["{0} {1:.1f}s".format(name, seconds) for name, seconds in sorted(self.workerTimers.items())]
+		if self.workerTimers:
+			times.append("worker idle {0:.1f}s".format(self.getWorkerIdle()))
+		print("{0} took {1:.1f}s{2}".format(self.stage, self.getElapsed(), ": " + ", ".join(times) if times else ""))
+
+	def toDict(self) -> dict:
+		elapsed = self.getElapsed()
+		return {
+			'stage': self.stage,
+			'seconds': elapsed,
+			'total': self.total,
+			'workers': self.numWorkers,
+			'counters': dict(self.counters),
+			'timers': dict(self.timers),
+			'workerTimers': dict(self.workerTimers),
+			'workerIdle': self.getWorkerIdle() if self.workerTimers else None,
+			'filesPerSecond': self.counters['files'] / elapsed,
+			'mbPerSecond': self.counters['bytes'] / elapsed / (1024 * 1024)
+		}
+
+def getPrometheusName(name: str) -> str:
+	return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+def writePrometheusText(filepath: str, metrics: list[StageMetrics]) -> None:
+	#node_exporter textfile collector format. Written to a temp file first, the collector may read it at any time
+	lines = [
+		"# HELP imgdb_stage_seconds Wall time of the last run of a stage.",
+		"# TYPE imgdb_stage_seconds gauge"
+	]
+	lines += ['imgdb_stage_seconds{{stage="{0}"}} {1:.6f}'.format(x.stage, x.getElapsed()) for x in metrics]
+	lines += ["# HELP imgdb_stage_items Counters of the last run of a stage.", "# TYPE imgdb_stage_items gauge"]
+	for cur in metrics:
+		lines += ['imgdb_stage_items{{stage="{0}",counter="{1}"}} {2}'.format(cur.stage, getPrometheusName(name), value)
+			for name, value in sorted(cur.counters.items())]
+	lines += ["# HELP imgdb_stage_timer_seconds Time spent per activity in the last run of a stage, worker timers are summed over workers.",
+		"# TYPE imgdb_stage_timer_seconds gauge"]
+	for cur in metrics:
+		lines += ['imgdb_stage_timer_seconds{{stage="{0}",timer="{1}",side="main"}} {2:.6f}'.format(cur.stage, getPrometheusName(name), value)
+			for name, value in sorted(cur.timers.items())]
+		lines += ['imgdb_stage_timer_seconds{{stage="{0}",timer="{1}",side="worker"}} {2:.6f}'.format(cur.stage, getPrometheusName(name), value)
+			for name, value in sorted(cur.workerTimers.items())]
+		if cur.workerTimers:
+			lines.append('imgdb_stage_timer_seconds{{stage="{0}",timer="idle",side="worker"}} {1:.6f}'.format(cur.stage, cur.getWorkerIdle()))
+	tempPath = filepath + ".tmp"
+	with open(tempPath, "w", encoding="utf8", newline="\n") as outFile:
+		outFile.write("\n".join(lines) + "\n")
+	os.replace(tempPath, filepath)
+
+class StageWriter:
+	def __init__(self, session: sqlalchemy.orm.Session, stage: str, commitRows: int, commitSeconds: float,
+			metrics: Optional[StageMetrics] = None) -> None:
+		self.session = session
+		self.stage = stage
+		self.metrics = metrics
+		self.commitRows = max(commitRows, 1)
+		self.commitSeconds = commitSeconds
+		self.pending: dict[object, list[dict]] = {}
+		self.numPending = 0
+		self.position = None
+		self.processed = 0
+		self.lastCommit = time.monotonic()
+		self.finished = False
+
+		checkpoint = session.query(StageCheckpoint.position, StageCheckpoint.processed) \
+			.filter(StageCheckpoint.stage == stage).first()
+		self.resumePosition = checkpoint[0] if checkpoint else None
+		self.resumeProcessed = (checkpoint[1] or 0) if checkpoint else 0
+		if checkpoint:
+			print("resuming {0} after {1} ({2} processed before)".format(stage, self.resumePosition, self.resumeProcessed))
+
+	def add(self, statement, row: dict) -> None:
+		self.pending.setdefault(statement, []).append(row)
+		self.numPending += 1
+
+	def advance(self, position, count: int = 1) -> None:
+		#positions must come in query order, everything up to here is done once committed. count is how many items that covers
+		self.position = position
+		self.processed += count
+		if (self.numPending >= self.commitRows) \
+				or ((time.monotonic() - self.lastCommit) >= self.commitSeconds):
+			self.commit()
+
+	def commit(self) -> None:
+		if self.metrics is None:
+			self.writePending()
+			return
+		with self.metrics.timer('dbWrite'):
+			self.writePending()
+
+	def writePending(self) -> None:
+		for statement, rows in self.pending.items():
+			self.session.execute(statement, rows)
+		self.pending.clear()
+		self.numPending = 0
+
+		if self.position is not None:
+			checkpointTable = StageCheckpoint.__table__
+			values = {
+				'position': str(self.position),
+				'processed': self.resumeProcessed + self.processed,
+				'updated': datetime.now()
+			}
+			updated = self.session.execute(
+				sqlalchemy.update(checkpointTable).where(checkpointTable.c.stage == self.stage).values(**values)
+			)
+			if not updated.rowcount:
+				self.session.execute(checkpointTable.insert().values(stage = self.stage, **values))
 
-		print("scan done, building queries")
+		self.session.commit()
+		self.lastCommit = time.monotonic()
 
-		newFiles = self.session.query(ScanFileData).filter(~ exists().where(FileData.path == ScanFileData.path))
-		deletedFiles = self.session.query(FileData).filter(~ exists().where(FileData.path == ScanFileData.path))
-		changedFiles = self.session.query(ScanFileData, FileData).filter(ScanFileData.path == FileData.path).filter(
-			(ScanFileData.size != FileData.size) or 
-			(ScanFileData.mtime != FileData.mtime) or 
-			(ScanFileData.ctime != FileData.ctime)
-		)
+	def finish(self) -> None:
+		self.commit()
+		checkpointTable = StageCheckpoint.__table__
+		self.session.execute(sqlalchemy.delete(checkpointTable).where(checkpointTable.c.stage == self.stage))
+		self.session.commit()
+		self.finished = True
 
-		numNewFiles = newFiles.count()
-		print("new files: {0}".format(numNewFiles))
-		numDeletedFiles = deletedFiles.count()
-		print("deleted files: {0}".format(numDeletedFiles))
-		numChangedFiles = changedFiles.count()
-		print("changed files: {0}".format(numChangedFiles))
+	def close(self) -> None:
+		if not self.finished:
+			print("saving {0} progress at {1}".format(self.stage, self.position))
+			self.commit()
 
-		print("processing deleted files: {0}".format(deletedFiles.count()))
-		fileIndex = 0
-		for f in deletedFiles.all():
-			fileIndex += 1
-			print("deleting file {0}/{1}".format(fileIndex, numDeletedFiles))
-			self.session.delete(f)
+class DbProcessor:
+	def carryMovedHashes(self, newFiles: list[dict], deletedIds: list[int]) -> int:
+		#a file that vanished in one place and showed up in another with the same size and mtime was moved, its hash still holds
+		candidates: dict[tuple[int, datetime], list[tuple[Optional[int], Optional[int], str]]] = {}
+		queryLimit = 500
+		for i in range(0, len(deletedIds), queryLimit):
+			deletedQuery = self.session.query(FileData.size, FileData.mtime, FileData.inode, FileData.device, FileData.hash) \
+				.filter(FileData.id.in_(deletedIds[i:i + queryLimit])) \
+				.filter(FileData.hash != DEFAULT_HASH)
+			for fileSize, fileMtime, fileInode, fileDevice, fileHash in deletedQuery:
+				candidates.setdefault((fileSize, fileMtime), []).append((fileInode, fileDevice, fileHash))
+		if not candidates:
+			return 0
+
+		numMoved = 0
+		numAmbiguous = 0
+		for newFile in newFiles:
+			matches = candidates.get((newFile['size'], newFile['mtime']))
+			if not matches:
+				continue
+			fileInode = newFile.get('inode')
+			fileDevice = newFile.get('device')
+			if fileInode is not None:
+				#a rename keeps the inode. A different inode on the same device is another file, even if it's the only one that fits
+				sameFile = [x for x in matches if (x[0] == fileInode) and (x[1] == fileDevice)]
+				matches = sameFile or [x for x in matches if (x[0] is None) or (x[1] != fileDevice)]
+			hashes = set(x[2] for x in matches)
+			if len(hashes) == 1:
+				newFile['hash'] = hashes.pop()
+				numMoved += 1
+			elif hashes:
+				numAmbiguous += 1
+		print("moved files: {0} kept their hash{1}".format(
+			numMoved, ", {0} ambiguous left for --hash".format(numAmbiguous) if numAmbiguous else ""))
+		return numMoved
+
+	def writeScanDelta(self, newFiles: list[dict], changedFiles: list[dict], deletedIds: list[int], 
+			identityFiles: Optional[list[dict]] = None) -> int:
+		filesTable = FileData.__table__
+		numMoved = 0
+		if newFiles and deletedIds:
+			numMoved = self.carryMovedHashes(newFiles, deletedIds)
+
+		if deletedIds:
+			print("processing deleted files: {0}".format(len(deletedIds)))
+			deleteLimit = 500
+			for i in range(0, len(deletedIds), deleteLimit):
+				self.session.execute(
+					sqlalchemy.delete(filesTable).where(filesTable.c.id.in_(deletedIds[i:i + deleteLimit]))
+				)
 
-		print("processing changed files: {0}".format(changedFiles.count()))
-		fileIndex = 0
-		for scanFile, file in changedFiles.all():
-			fileIndex += 1
-			print("processing changed file {1}/{2}: {0}".format(scanFile.path, fileIndex, numNewFiles))
-			file.ctime = scanFile.ctime
-			file.mtime = scanFile.mtime
-			file.size = scanFile.size
-			file.hash = DEFAULT_HASH
-
-		print("processing new files: {0}".format(newFiles.count()))
-		fileIndex = 0
-		#for newData in pool.imap(makeFileData, newFiles.all()):
-		for scanFile in newFiles.all():
-			fileIndex += 1
-			print("adding new file {1}/{2}: {0}".format(scanFile.path, fileIndex, numNewFiles))
-			newData = FileData(
-				path = scanFile.path,
-				size = scanFile.size,
-				mtime = scanFile.mtime,
-				ctime = scanFile.ctime,
-
-				hash = DEFAULT_HASH
+		if changedFiles:
+			print("processing changed files: {0}".format(len(changedFiles)))
+			changedUpdate = sqlalchemy.update(filesTable) \
+				.where(filesTable.c.id == sqlalchemy.bindparam('fileId')) \
+				.values(
+					size = sqlalchemy.bindparam('fileSize'),
+					ctime = sqlalchemy.bindparam('fileCtime'),
+					mtime = sqlalchemy.bindparam('fileMtime'),
+					inode = sqlalchemy.bindparam('fileInode'),
+					device = sqlalchemy.bindparam('fileDevice'),
+					hash = DEFAULT_HASH
+				)
+			self.session.execute(changedUpdate, changedFiles)
+
+		if identityFiles:
+			#rows from before inodes were recorded, filled in as their directories get listed
+			identityUpdate = sqlalchemy.update(filesTable) \
+				.where(filesTable.c.id == sqlalchemy.bindparam('fileId')) \
+				.values(inode = sqlalchemy.bindparam('fileInode'), device = sqlalchemy.bindparam('fileDevice'))
+			self.session.execute(identityUpdate, identityFiles)
+
+		if newFiles:
+			print("processing new files: {0}".format(len(newFiles)))
+			self.session.execute(makeInsert(filesTable), newFiles)
+		return numMoved
+
+	def writeDirDelta(self, newDirs: list[dict], changedDirs: list[dict], deletedIds: list[int]):
+		dirsTable = DirData.__table__
+		deleteLimit = 500
+		for i in range(0, len(deletedIds), deleteLimit):
+			self.session.execute(
+				sqlalchemy.delete(dirsTable).where(dirsTable.c.id.in_(deletedIds[i:i + deleteLimit]))
 			)
-			self.session.add(newData)
+		if changedDirs:
+			dirUpdate = sqlalchemy.update(dirsTable) \
+				.where(dirsTable.c.id == sqlalchemy.bindparam('dirId')) \
+				.values(
+					path = sqlalchemy.bindparam('dirPath'),
+					parent = sqlalchemy.bindparam('dirParent'),
+					mtime = sqlalchemy.bindparam('dirMtime'),
+					listed = sqlalchemy.bindparam('dirListed')
+				)
+			self.session.execute(dirUpdate, changedDirs)
+		if newDirs:
+			self.session.execute(makeInsert(dirsTable), newDirs)
+
+	def scanFilesystem(self, fullScan: bool = False):
+		metrics = self.startMetrics(STAGE_SCAN)
+		try:
+			return self.scanFiles(metrics, fullScan)
+		finally:
+			metrics.finish()
+
+	def scanFiles(self, metrics: StageMetrics, fullScan: bool):
+		print("loading known files")
+		#grouped by directory, so an unchanged directory can be accepted as a whole without stat-ing its files
+		knownFiles: dict[str, dict[str, tuple[int, int, datetime, datetime, Optional[int]]]] = {}
+		numKnownFiles = 0
+		knownQuery = self.session.query(FileData.id, FileData.path, FileData.size, FileData.ctime, FileData.mtime, FileData.inode)
+		for fileId, filePath, fileSize, fileCtime, fileMtime, fileInode in knownQuery.yield_per(10000):
+			knownFiles.setdefault(os.path.normpath(os.path.dirname(filePath)), {})[filePath] = (fileId, fileSize, fileCtime, fileMtime, fileInode)
+			numKnownFiles += 1
+		print("known files: {0}".format(numKnownFiles))
+
+		#paths are compared normalized, "img" and "img/" in the config are the same root
+		knownDirs: dict[str, tuple[int, datetime, datetime]] = {}
+		childDirs: dict[str, list[str]] = {}
+		staleDirIds = []
+		dirQuery = self.session.query(DirData.id, DirData.path, DirData.parent, DirData.mtime, DirData.listed)
+		for dirId, dirPath, dirParent, dirMtime, dirListed in dirQuery.yield_per(10000):
+			dirPath = os.path.normpath(dirPath)
+			if dirPath in knownDirs:
+				#the same directory stored under two spellings, the other one gets listed again
+				staleDirIds.append(dirId)
+				staleDirIds.append(knownDirs.pop(dirPath)[0])
+				continue
+			knownDirs[dirPath] = (dirId, dirMtime, dirListed)
+			childDirs.setdefault(os.path.normpath(dirParent) if dirParent else None, []).append(dirPath)
+		print("known directories: {0}".format(len(knownDirs)))
+
+		print("full filesystem scan" if fullScan else "scanning filesystem")
+		newFiles = []
+		changedFiles = []
+		identityFiles = []
+		deletedIds = []
+		newDirs = []
+		changedDirs = []
+		visitedDirs = set()
+		numListed = 0
+		numSkipped = 0
+		numScanned = 0
+		#directories modified this close to their listing might have changed again within the same mtime tick
+		racyWindow = 2.0
+		for curPath in self.config.paths:
+			dirStack = [(os.path.normpath(curPath), None)]
+			while dirStack:
+				curDir, parentDir = dirStack.pop()
+				if (curDir in visitedDirs) or self.config.isExcludedPath(curDir):
+					continue
+				visitedDirs.add(curDir)
+				try:
+					dirMtime = datetime.fromtimestamp(os.stat(curDir).st_mtime)
+				except OSError as e:
+					print("cannot stat {0}: {1}".format(curDir, e))
+					continue
 
-		self.session.query(ScanFileData).delete()
-		print("committing to db")	
+				knownDir = knownDirs.pop(curDir, None)
+				if (not fullScan) and knownDir \
+						and (knownDir[1] == dirMtime) \
+						and ((knownDir[2] - dirMtime).total_seconds() > racyWindow):
+					numSkipped += 1
+					knownFiles.pop(curDir, None)
+					dirStack.extend((x, curDir) for x in childDirs.get(curDir, []))
+					continue
 
-		self.session.commit()
+				listedTime = datetime.now()
+				try:
+					with metrics.timer('list'):
+						subDirs, dirFiles = listDirectory(self.config, curDir)
+				except OSError as e:
+					print("cannot list {0}: {1}".format(curDir, e))
+					metrics.count('errors')
+					continue
+				numListed += 1
+				dirStack.extend((x, curDir) for x in subDirs)
+
+				if knownDir:
+					changedDirs.append({'dirId': knownDir[0], 'dirPath': curDir, 'dirParent': parentDir,
+						'dirMtime': dirMtime, 'dirListed': listedTime})
+				else:
+					newDirs.append({'path': curDir, 'parent': parentDir, 'mtime': dirMtime, 'listed': listedTime})
+
+				knownDirFiles = knownFiles.pop(curDir, {})
+				for filePath, fileStat in dirFiles:
+					numScanned += 1
+					if self.verbose:
+						print("scanning: {0}".format(filePath))
+					scanData = getScanData(fileStat)
+					fileIdentity = getFileIdentity(fileStat)
+					metrics.count('files')
+					metrics.count('bytes', scanData[0])
+					known = knownDirFiles.pop(filePath, None)
+					if known is None:
+						newFiles.append({
+							'path': filePath,
+							'size': scanData[0],
+							'ctime': scanData[1],
+							'mtime': scanData[2],
+							'hash': DEFAULT_HASH,
+							'inode': fileIdentity[0],
+							'device': fileIdentity[1]
+						})
+					elif known[1:4] != scanData:
+						changedFiles.append({
+							'fileId': known[0],
+							'fileSize': scanData[0],
+							'fileCtime': scanData[1],
+							'fileMtime': scanData[2],
+							'fileInode': fileIdentity[0],
+							'fileDevice': fileIdentity[1]
+						})
+					elif (known[4] is None) and (fileIdentity[0] is not None):
+						identityFiles.append({'fileId': known[0], 'fileInode': fileIdentity[0], 'fileDevice': fileIdentity[1]})
+				deletedIds.extend(x[0] for x in knownDirFiles.values())
+				metrics.progress()
+
+		for dirFiles in knownFiles.values():
+			deletedIds.extend(x[0] for x in dirFiles.values())
+		deletedDirIds = [x[0] for x in knownDirs.values()] + staleDirIds
+		knownFiles.clear()
+		knownDirs.clear()
+		print("scan done: {0} directories listed, {1} unchanged directories skipped, {2} files checked".format(
+			numListed, numSkipped, numScanned))
+
+		print("new files: {0}".format(len(newFiles)))
+		print("deleted files: {0}".format(len(deletedIds)))
+		print("changed files: {0}".format(len(changedFiles)))
+		metrics.count('dirsListed', numListed)
+		metrics.count('dirsSkipped', numSkipped)
+		metrics.count('new', len(newFiles))
+		metrics.count('changed', len(changedFiles))
+		metrics.count('deleted', len(deletedIds))
+
+		with metrics.timer('dbWrite'):
+			metrics.count('moved', self.writeScanDelta(newFiles, changedFiles, deletedIds, identityFiles))
+			self.writeDirDelta(newDirs, changedDirs, deletedDirIds)
+
+			print("committing to db")	
+
+			self.session.commit()
 		print("committed")
-		pass
+		return len(newFiles) + len(changedFiles) + len(deletedIds)
+
+	def syncPaths(self, filePaths: set[str], removedDirs: set[str]) -> int:
+		deletedIds = []
+		dirsTable = DirData.__table__
+		#"./img/a.png" would be inserted next to "img/a.png"
+		filePaths = set(os.path.normpath(x) for x in filePaths)
+		removedDirs = set(os.path.normpath(x) for x in removedDirs)
+		for dirPath in removedDirs:
+			dirPrefix = os.path.join(dirPath, '')
+			deletedIds.extend(x[0] for x in self.session.query(FileData.id) \
+				.filter(FileData.path.startswith(dirPrefix, autoescape=True)))
+			self.session.execute(sqlalchemy.delete(dirsTable).where(
+				(dirsTable.c.path == dirPath) | dirsTable.c.path.startswith(dirPrefix, autoescape=True)
+			))
+
+		filePaths = [x for x in filePaths 
+			if self.config.isSupportedExt(x) and not self.config.isExcludedPath(os.path.dirname(x))]
+		knownFiles: dict[str, tuple[int, int, datetime, datetime]] = {}
+		queryLimit = 500
+		for i in range(0, len(filePaths), queryLimit):
+			knownQuery = self.session.query(FileData.id, FileData.path, FileData.size, FileData.ctime, FileData.mtime) \
+				.filter(FileData.path.in_(filePaths[i:i + queryLimit]))
+			for fileId, filePath, fileSize, fileCtime, fileMtime in knownQuery:
+				knownFiles[filePath] = (fileId, fileSize, fileCtime, fileMtime)
+
+		newFiles = []
+		changedFiles = []
+		knownIds = set(deletedIds)
+		for filePath in filePaths:
+			known = knownFiles.get(filePath)
+			try:
+				fileStat = os.stat(filePath)
+			except OSError:
+				fileStat = None
+			if (fileStat is None) or not stat.S_ISREG(fileStat.st_mode):
+				if known and known[0] not in knownIds:
+					deletedIds.append(known[0])
+					knownIds.add(known[0])
+				continue
+			scanData = getScanData(fileStat)
+			fileIdentity = getFileIdentity(fileStat)
+			if known is None:
+				newFiles.append({
+					'path': filePath,
+					'size': scanData[0],
+					'ctime': scanData[1],
+					'mtime': scanData[2],
+					'hash': DEFAULT_HASH,
+					'inode': fileIdentity[0],
+					'device': fileIdentity[1]
+				})
+			elif known[1:] != scanData:
+				changedFiles.append({
+					'fileId': known[0],
+					'fileSize': scanData[0],
+					'fileCtime': scanData[1],
+					'fileMtime': scanData[2],
+					'fileInode': fileIdentity[0],
+					'fileDevice': fileIdentity[1]
+				})
+			elif known[0] in knownIds:
+				#directory went away and came back with the same file, keep the row
+				deletedIds.remove(known[0])
+				knownIds.discard(known[0])
+
+		print("new files: {0}, changed files: {1}, deleted files: {2}".format(
+			len(newFiles), len(changedFiles), len(deletedIds)))
+		self.writeScanDelta(newFiles, changedFiles, deletedIds)
+		self.session.commit()
+		return len(newFiles) + len(changedFiles) + len(deletedIds)
+
+	def runWatchStages(self, imgHash: bool, pal: bool, ocr: bool, ocrLang: str, ocrMask: Optional[str]):
+		self.buildHashes()
+		artifacts = []
+		if imgHash:
+			artifacts.append(ANALYZE_DHASH)
+		if pal:
+			artifacts.append(ANALYZE_PAL)
+		if ocr:
+			artifacts.append(ANALYZE_OCR)
+		self.buildAnalysis(artifacts, ocrLang, ocrMask)
+
+	def watchFilesystem(self, imgHash: bool, pal: bool, ocr: bool, ocrLang: str = 'eng', 
+			ocrMask: Optional[str] = None, pollInterval: float = 60.0):
+		settleTime = 2.0
+		maxBatchTime = 30.0
+
+		print("initial sync")
+		self.scanFilesystem()
+		self.runWatchStages(imgHash, pal, ocr, ocrLang, ocrMask)
+
+		watcher = None
+		if InotifyWatcher.isAvailable():
+			try:
+				watcher = InotifyWatcher()
+				self.addWatches(watcher, self.config.paths)
+				print("watching {0} directories with inotify".format(len(watcher.watches)))
+			except OSError as e:
+				print("inotify unavailable ({0}), falling back to polling".format(e))
+				if watcher:
+					watcher.close()
+				watcher = None
+
+		if watcher is None:
+			self.pollFilesystem(imgHash, pal, ocr, ocrLang, ocrMask, pollInterval)
+			return
 
-	def buildHashes(self):
+		try:
+			dirtyFiles: set[str] = set()
+			addedDirs: set[str] = set()
+			removedDirs: set[str] = set()
+			needRescan = False
+			batchStart = None
+			while True:
+				events = watcher.readEvents(settleTime)
+				if events is None:
+					print("inotify queue overflow, rescanning")
+					needRescan = True
+					events = []
+				if events and batchStart is None:
+					batchStart = time.monotonic()
+
+				for mask, path in events:
+					if mask & InotifyWatcher.IN_ISDIR:
+						if self.config.isExcludedPath(path):
+							continue
+						if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+							addedDirs.add(path)
+						elif mask & (InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM):
+							watcher.removeTree(path)
+							removedDirs.add(path)
+							addedDirs.discard(path)
+					elif mask & (InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF):
+						#watched root itself went away, the parent (if watched) reports the rest
+						watcher.removeTree(path)
+						removedDirs.add(path)
+					else:
+						dirtyFiles.add(path)
+
+				if batchStart is None and not needRescan:
+					continue
+				if events and (time.monotonic() - batchStart) < maxBatchTime:
+					continue
+
+				try:
+					if needRescan:
+						#directories created while events were lost have no watch yet, adding one twice is harmless
+						self.addWatches(watcher, self.config.paths)
+						self.scanFilesystem()
+					else:
+						for dirPath in self.addWatches(watcher, addedDirs):
+							try:
+								with os.scandir(dirPath) as entries:
+									dirtyFiles.update(x.path for x in entries if not x.is_dir(follow_symlinks=False))
+							except OSError:
+								pass
+						print("processing changes: {0} files, {1} new directories, {2} removed directories".format(
+							len(dirtyFiles), len(addedDirs), len(removedDirs)))
+						self.syncPaths(dirtyFiles, removedDirs)
+				except OSError as e:
+					#out of watches (ENOSPC) or a directory we can't watch, a partly watched tree would miss changes
+					print("cannot watch all directories ({0}), falling back to polling".format(e))
+					break
+				self.runWatchStages(imgHash, pal, ocr, ocrLang, ocrMask)
+
+				dirtyFiles.clear()
+				addedDirs.clear()
+				removedDirs.clear()
+				needRescan = False
+				batchStart = None
+		finally:
+			watcher.close()
+
+		#whatever happened since the last batch is picked up by a full rescan
+		if self.scanFilesystem():
+			self.runWatchStages(imgHash, pal, ocr, ocrLang, ocrMask)
+		self.pollFilesystem(imgHash, pal, ocr, ocrLang, ocrMask, pollInterval)
+
+	def addWatches(self, watcher: InotifyWatcher, rootPaths) -> list[str]:
+		#event paths are built from these, they have to be spelled the way scanFiles stores them
+		dirPaths = []
+		for rootPath in rootPaths:
+			for dirPath in walkDirectories(self.config, os.path.normpath(rootPath)):
+				watcher.addWatch(dirPath)
+				dirPaths.append(dirPath)
+		return dirPaths
+
+	def pollFilesystem(self, imgHash: bool, pal: bool, ocr: bool, ocrLang: str, ocrMask: Optional[str], pollInterval: float):
+		#the directory-level rescan doesn't see files overwritten in place, every so often check every file
+		fullScanInterval = 3600.0
+		print("polling every {0} seconds, checking every file every {1} seconds".format(pollInterval, fullScanInterval))
+		lastFullScan = time.monotonic()
+		while True:
+			time.sleep(pollInterval)
+			fullScan = (time.monotonic() - lastFullScan) >= fullScanInterval
+			if fullScan:
+				lastFullScan = time.monotonic()
+			if self.scanFilesystem(fullScan):
+				self.runWatchStages(imgHash, pal, ocr, ocrLang, ocrMask)
+
+	def makeStageWriter(self, stage: str, metrics: Optional[StageMetrics] = None) -> StageWriter:
+		return StageWriter(self.session, stage, self.config.commitRows, self.config.commitSeconds, metrics)
+
+	def startMetrics(self, stage: str) -> StageMetrics:
+		#last run of every stage, for --statsjson and --statsprom
+		metrics = StageMetrics(stage, self.config.progressSeconds)
+		self.stageMetrics[stage] = metrics
+		return metrics
+
+	def runStage(self, stage: str, stageFunc, *args):
+		if self.profileStage != stage:
+			return stageFunc(*args)
+		#only this process is profiled, worker pools show up as time spent waiting on them
+		profiler = cProfile.Profile()
+		profiler.enable()
+		try:
+			return stageFunc(*args)
+		finally:
+			profiler.disable()
+			profilePath = "imgdb-{0}.prof".format(stage)
+			profiler.dump_stats(profilePath)
+			print("profile of {0} saved to {1}, top functions by cumulative time:".format(stage, profilePath))
+			pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+	def writeStats(self, jsonPath: Optional[str], promPath: Optional[str]) -> None:
+		metrics = list(self.stageMetrics.values())
+		if jsonPath:
+			with open(jsonPath, "w", encoding="utf8") as outFile:
+				json.dump({
+					'date': datetime.now().isoformat(timespec='seconds'),
+					'dbpath': self.config.dbpath,
+					'stages': [x.toDict() for x in metrics]
+				}, outFile, indent='\t')
+			print("stage stats saved to {0}".format(jsonPath))
+		if promPath:
+			writePrometheusText(promPath, metrics)
+			print("prometheus stats saved to {0}".format(promPath))
+
+	def buildHashes(self, numWorkers: Optional[int] = None):
 		print("building file hashes")
-		missingHashes = self.session.query(FileData).filter(FileData.hash == '')
-		print("Hashes missing: {0}".format(missingHashes.count()))
+		metrics = self.startMetrics(STAGE_HASH)
+		writer = self.makeStageWriter('hash', metrics)
+		missingHashes = self.session.query(FileData.id, FileData.path, FileData.size) \
+			.filter(FileData.hash == DEFAULT_HASH) \
+			.order_by(FileData.id)
+		if writer.resumePosition is not None:
+			missingHashes = missingHashes.filter(FileData.id > int(writer.resumePosition))
 
-		fileIndex = 0
 		numFiles = missingHashes.count()
-		for fileData in missingHashes.all():
-			fileIndex += 1
-			print("building hash {1}/{2}for: {0}".format(fileData.path, fileIndex, numFiles))
-			fileData.hash = getDigest(fileData.path)
+		print("Hashes missing: {0}".format(numFiles))
+		if not numFiles:
+			writer.finish()
+			metrics.finish()
+			return
 
-		print("committing to session")
-		self.session.commit()
-		
+		if numWorkers is None:
+			numWorkers = self.config.hashWorkers
+		metrics.total = numFiles
+		metrics.numWorkers = numWorkers if numWorkers > 0 else os.cpu_count()
+		useThreads = self.config.hashPool != 'process'
+		useMmap = self.config.hashMmap
+		print("hashing with {0} {1} worker(s){2}".format(
+			numWorkers if numWorkers > 0 else os.cpu_count(),
+			'thread' if useThreads else 'process',
+			', mmap' if useMmap else ''
+		))
+
+		filesTable = FileData.__table__
+		hashUpdate = sqlalchemy.update(filesTable) \
+			.where(filesTable.c.id == sqlalchemy.bindparam('fileId')) \
+			.values(hash = sqlalchemy.bindparam('fileHash'))
+		fileIndex = 0
+		try:
+			with makeWorkerPool(numWorkers, useThreads) as pool:
+				#ordered, so the checkpoint never skips a file that is still being hashed
+				for data in metrics.wait(pool.imap(makeHashData, 
+						((tuple(x), useMmap) for x in missingHashes.all()))):
+					if not data:
+						raise OperationInterruptedException()
+					fileData = data[0]
+					fileHash = data[1]
+					err = data[2]
+					metrics.addWorkerTimes(data[3])
+					fileIndex += 1
+					metrics.count('files')
+					if isinstance(err, Exception):
+						print("exception: {0}: {1}".format(err, fileData[1]))
+						metrics.count('errors')
+						writer.advance(fileData[0])
+						continue
 
-	def buildDhashes(self):
+					metrics.count('bytes', fileData[2] or 0)
+					if self.verbose:
+						print("building hash {1}/{2} for: {0}".format(fileData[1], fileIndex, numFiles))
+					metrics.progress()
+					writer.add(hashUpdate, {'fileId': fileData[0], 'fileHash': fileHash})
+					writer.advance(fileData[0])
+			writer.finish()
+		finally:
+			writer.close()
+			metrics.finish()
+
+	def buildDhashes(self, workSize: Optional[int] = None):
 		print("building dhashes")
-		missingDHashes = self.session.query(FileData) \
+		if workSize is None:
+			workSize = self.config.workSize
+		metrics = self.startMetrics(STAGE_DHASH)
+		writer = self.makeStageWriter('dhash', metrics)
+		missingDHashes = self.session.query(FileData.path, FileData.size, FileData.hash) \
 			.filter(FileData.hash != DEFAULT_HASH) \
 			.filter(~ exists().where(FileData.hash == DHashData.hash)) \
-			.group_by(FileData.hash)
+			.group_by(FileData.hash) \
+			.order_by(FileData.hash)
+		if writer.resumePosition is not None:
+			missingDHashes = missingDHashes.filter(FileData.hash > writer.resumePosition)
 
-		print("DHashes missing: {0}".format(missingDHashes.count()))
+		numFiles = missingDHashes.count()
+		print("DHashes missing: {0}".format(numFiles))
+		if not numFiles:
+			writer.finish()
+			metrics.finish()
+			return
+		metrics.total = numFiles
+		metrics.numWorkers = os.cpu_count()
 		dhashSize = 8
 		fileIndex = 0
-		numFiles = missingDHashes.count()
-		with mp.Pool() as pool:
-			for curData in pool.imap(
-					makeDHashData, ((x, dhashSize) for x in missingDHashes.all())):
-				if not curData:
-					raise OperationInterruptedException()
-				fileIndex += 1
-				newData = curData[0]
-				path = curData[1]
-				if isinstance(newData, Exception):
-					print("exception: {0}, file: {1}".format(newData, path))
-					continue
-				print("building hash {1}/{2}for: {0} : {3}".format(path, fileIndex, numFiles, newData.dhash))
-				self.session.add(newData)
-			
-		print("commiting")
-		self.session.commit()
+		dhashInsert = makeInsert(DHashData.__table__)
+		try:
+			with mp.Pool() as pool:
+				for curData in metrics.wait(pool.imap(
+						makeDHashData, ((tuple(x), dhashSize, workSize) for x in missingDHashes.all()))):
+					if not curData:
+						raise OperationInterruptedException()
+					fileIndex += 1
+					newData = curData[0]
+					fileData = curData[1]
+					err = curData[2]
+					metrics.addWorkerTimes(curData[3])
+					metrics.count('files')
+					metrics.count('bytes', fileData[1] or 0)
+					if isinstance(err, Exception):
+						print("exception: {0}, file: {1}".format(err, fileData[0]))
+						metrics.count('errors')
+						writer.advance(fileData[2])
+						continue
+					if self.verbose:
+						print("building hash {1}/{2}for: {0} : {3}".format(fileData[0], fileIndex, numFiles, newData['dhash']))
+					metrics.progress()
+					writer.add(dhashInsert, newData)
+					writer.advance(fileData[2])
+			writer.finish()
+		finally:
+			writer.close()
+			metrics.finish()
 
 		pass
 
@@ -729,7 +2421,101 @@ class DbProcessor:
 		self.session.query(OcrData).filter(OcrData.lang == ocrLang).delete()
 		self.session.commit()
 
-	def searchText(self, textPattern, ocrLang='eng', brief: bool = False):
+	def hasFtsIndex(self, ftsTable: str) -> bool:
+		return self.session.execute(sqlalchemy.text(
+			"SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = :name"
+		), {'name': ftsTable}).scalar() > 0
+
+	def createFtsIndex(self, ftsTable: str) -> bool:
+		#plain fts5 table rather than external content, so the delete trigger can't corrupt it for rows not backfilled yet
+		sourceTable, columns, options, updateColumns = FTS_INDEXES[ftsTable]
+		columnList = ", ".join(x.split()[0] for x in columns)
+		newValues = ", ".join("new.{0}".format(x.split()[0]) for x in columns)
+		statements = [
+			"CREATE VIRTUAL TABLE {0} USING fts5({1}, {2})".format(ftsTable, ", ".join(columns), options),
+			"CREATE TRIGGER {0}_ai AFTER INSERT ON {1} BEGIN "
+				"INSERT INTO {0}(rowid, {2}) VALUES (new.id, {3}); END".format(ftsTable, sourceTable, columnList, newValues),
+			"CREATE TRIGGER {0}_ad AFTER DELETE ON {1} BEGIN "
+				"DELETE FROM {0} WHERE rowid = old.id; END".format(ftsTable, sourceTable),
+			"CREATE TRIGGER {0}_au AFTER UPDATE OF {4} ON {1} BEGIN "
+				"DELETE FROM {0} WHERE rowid = old.id; "
+				"INSERT INTO {0}(rowid, {2}) VALUES (new.id, {3}); END".format(ftsTable, sourceTable, columnList, newValues, updateColumns)
+		]
+		try:
+			for statement in statements:
+				self.session.execute(sqlalchemy.text(statement))
+		except sqlalchemy.exc.OperationalError as e:
+			self.session.rollback()
+			print("cannot create index {0}, sqlite has no fts5? ({1})".format(ftsTable, e.orig))
+			return False
+		#rows inserted from now on are indexed by the triggers, the rest is backfilled by buildFtsIndex
+		self.session.execute(StageCheckpoint.__table__.insert().values(
+			stage = ftsTable, position = "0", processed = 0, updated = datetime.now()
+		))
+		self.session.commit()
+		print("created index {0}".format(ftsTable))
+		return True
+
+	def buildFtsIndex(self, ftsTable: str) -> bool:
+		if not self.hasFtsIndex(ftsTable) and not self.createFtsIndex(ftsTable):
+			return False
+		writer = self.makeStageWriter(ftsTable)
+		if writer.resumePosition is None:
+			writer.finished = True
+			return True
+
+		sourceTable, columns, options, updateColumns = FTS_INDEXES[ftsTable]
+		table = Base.metadata.tables[sourceTable]
+		columnList = ", ".join(x.split()[0] for x in columns)
+		lastId = int(writer.resumePosition)
+		numRows = self.session.execute(
+			sqlalchemy.select(func.count(table.c.id)).where(table.c.id > lastId)
+		).scalar()
+		print("{0} rows to index: {1}".format(sourceTable, numRows))
+		#rows inserted since the index was created are in it already through the triggers, looked up by rowid one at a time
+		backfill = sqlalchemy.text(
+			"INSERT INTO {0}(rowid, {2}) SELECT id, {2} FROM {1} "
+			"WHERE id > :firstId AND id <= :lastId "
+			"AND NOT EXISTS (SELECT 1 FROM {0} WHERE {0}.rowid = {1}.id)".format(ftsTable, sourceTable, columnList)
+		)
+		batchSize = 5000
+		try:
+			while True:
+				batchIds = self.session.execute(
+					sqlalchemy.select(table.c.id).where(table.c.id > lastId).order_by(table.c.id).limit(batchSize)
+				).scalars().all()
+				if not batchIds:
+					break
+				writer.add(backfill, {'firstId': lastId, 'lastId': batchIds[-1]})
+				lastId = batchIds[-1]
+				writer.advance(lastId, len(batchIds))
+				print("indexed {0} {1}/{2}".format(sourceTable, writer.processed, numRows))
+			writer.finish()
+		finally:
+			writer.close()
+		return True
+
+	def buildFtsIndexes(self) -> None:
+		for ftsTable in FTS_INDEXES:
+			self.buildFtsIndex(ftsTable)
+
+	def getPathCondition(self, pattern: str):
+		#ilike alone scans every path. The trigram index narrows it down first when the pattern has 3+ chars in a row to look for
+		condition = FileData.path.ilike(pattern)
+		if max(len(x) for x in re.split('[%_]', pattern)) >= 3 and self.buildFtsIndex(PATH_FTS_TABLE):
+			candidates = sqlalchemy.select(sqlalchemy.column('rowid')) \
+				.select_from(sqlalchemy.table(PATH_FTS_TABLE)) \
+				.where(sqlalchemy.column('path').like(pattern))
+			condition = FileData.id.in_(candidates) & condition
+		return condition
+
+	def searchText(self, textPattern, ocrLang='eng', brief: bool = False, fullText: bool = False):
+		if fullText:
+			if self.buildFtsIndex(OCR_FTS_TABLE):
+				self.searchFullText(textPattern, ocrLang, brief)
+				return
+			print("falling back to ilike, pattern is used as is")
+
 		textQuery = self.session.query(FileData.path, OcrData.text) \
 			.filter(OcrData.hash == FileData.hash) \
 			.filter(OcrData.lang == ocrLang) \
@@ -748,65 +2534,481 @@ class DbProcessor:
 			else:
 				print("{0}:\n{1}\n".format(cur[0], str(cur[1]).replace('\n', '\\')))
 
-	def buildOcr(self, ocrLang='eng', mask=None):
+	def searchFullText(self, ftsQuery: str, ocrLang='eng', brief: bool = False):
+		#fts5 query syntax: words, prefix*, "some phrase", AND/OR/NOT, NEAR(...). Best bm25 match first
+		textQuery = sqlalchemy.text(
+			"SELECT files.path, ocr.text, min(hits.score) AS score FROM "
+			"(SELECT rowid AS ocrId, rank AS score FROM {0} WHERE {0} MATCH :query AND lang = :lang) AS hits "
+			"JOIN ocr ON ocr.id = hits.ocrId "
+			"JOIN files ON files.hash = ocr.hash "
+			"GROUP BY ocr.hash "
+			"ORDER BY score, files.path".format(OCR_FTS_TABLE)
+		)
+		try:
+			results = self.session.execute(textQuery, {'query': ftsQuery, 'lang': ocrLang}).all()
+		except sqlalchemy.exc.OperationalError as e:
+			print("bad full text query \"{0}\": {1}".format(ftsQuery, e.orig))
+			return
+
+		if not brief:
+			print("{0} result(s)".format(len(results)))
+
+		for cur in results:
+			if brief:
+				print(cur[0])
+			else:
+				print("{0} ({2:.2f}):\n{1}\n".format(cur[0], str(cur[1]).replace('\n', '\\'), -cur[2]))
+
+	def getOcrInsert(self, force: bool):
+		if not force:
+			return makeInsert(OcrData.__table__)
+		#forced runs replace what was skipped or timed out before
+		ocrInsert = sqliteInsert(OcrData.__table__)
+		return ocrInsert.on_conflict_do_update(
+			index_elements = ['hash', 'lang'],
+			set_ = {'size': ocrInsert.excluded.size, 'text': ocrInsert.excluded.text, 'status': ocrInsert.excluded.status}
+		)
+
+	def getOcrLimits(self) -> tuple[float, int, int]:
+		return (self.config.ocrTimeout, self.config.ocrMaxPixels, self.config.ocrMaxDpi)
+
+	def getHasOcr(self, ocrLang: str, force: bool):
+		hasOcr = (FileData.hash == OcrData.hash) & (OcrData.lang == ocrLang)
+		if force:
+			hasOcr = hasOcr & sqlalchemy.or_(OcrData.status == None, OcrData.status.not_in(OCR_RETRY_STATUSES))
+		return exists().where(hasOcr)
+
+	def buildOcr(self, ocrLang='eng', mask=None, numWorkers: Optional[int] = None, force: bool = False):
 		pytesseract.pytesseract.tesseract_cmd = self.config.tesscmd
 
 		print("tess languages: {0}".format(pytesseract.get_languages()))
-		missingOcr = self.session.query(FileData) \
+		metrics = self.startMetrics(STAGE_OCR)
+		writer = self.makeStageWriter("ocr:{0}:{1}{2}".format(ocrLang, mask or '', ':force' if force else ''), metrics)
+		missingOcr = self.session.query(FileData.path, FileData.size, FileData.hash) \
 			.filter(FileData.hash != DEFAULT_HASH) \
-			.filter(~ exists().where((FileData.hash == OcrData.hash) & (OcrData.lang == ocrLang))) \
-			.group_by(FileData.hash)
+			.filter(~ self.getHasOcr(ocrLang, force)) \
+			.group_by(FileData.hash) \
+			.order_by(FileData.hash)
+		if writer.resumePosition is not None:
+			missingOcr = missingOcr.filter(FileData.hash > writer.resumePosition)
 
 		#print(missingOcr)
 		if (mask):
-			missingOcr = missingOcr.filter(FileData.path.ilike(mask))
+			missingOcr = missingOcr.filter(self.getPathCondition(mask))
 			print(missingOcr)
 		numFiles = missingOcr.count()
 		print("missing translations: {0}".format(numFiles))
+		if not numFiles:
+			writer.finish()
+			metrics.finish()
+			return
 		fileIndex = 0
 
-		useFullData = False
-		with mp.Pool() as pool:
-			fileLimit = 1000
-			for data in pool.imap(makeOcrData, 
+		if numWorkers is None:
+			numWorkers = self.config.ocrWorkers
+		if numWorkers <= 0:
+			numWorkers = os.cpu_count()
+		metrics.total = numFiles
+		metrics.numWorkers = numWorkers
+		batchSize = max(self.config.ocrBatch, 1)
+		minTextBlocks = 0 if force else self.config.ocrMinTextBlocks
+		print("ocr with {0} tesseract worker(s), {1} image(s) per run{2}".format(
+			numWorkers, batchSize, ", skipping images with less than {0} text block(s)".format(minTextBlocks) if minTextBlocks > 0 else ""))
+		#parallel tesseracts each using every core just fight over them
+		os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+		ocrInsert = self.getOcrInsert(force)
+		numSkipped = 0
+		numTimeouts = 0
+		numOcred = 0
+		ocrTime = 0.0
+		filterTime = 0.0
+		#batches finish in any order, the checkpoint only moves past batches that are done along with everything before them
+		finishedBatches = {}
+		nextBatch = 0
+		ocrLimits = self.getOcrLimits()
+		prevPixelLimit = allowLargeOcrImages()
+		try:
+			with mp.pool.ThreadPool(numWorkers) as pool:
+				batches = pool.imap_unordered(makeOcrBatch, 
 					(
-						((x.path, x.size, x.hash), self.config.tesscmd, ocrLang, useFullData) for x in missingOcr.all()
-					)):
-				if not data:
-					raise OperationInterruptedException()
-
-				err = data[2]
-				ocrTuple = data[0]
-				fileData: tuple[str, int, str] = data[1]
-				filePath = fileData[0]
-				fileSize = fileData[1]
-				fileHash = fileData[2]
+						(batchIndex, [tuple(x) for x in batch], self.config.tesscmd, ocrLang, minTextBlocks, ocrLimits)
+						for batchIndex, batch in enumerate(makeBatches(missingOcr.all(), batchSize))
+					))
+				for batchResult in metrics.wait(batches):
+					if batchResult is None:
+						raise OperationInterruptedException()
+					batchIndex, batchData = batchResult
+					for data in batchData:
+						if not data:
+							raise OperationInterruptedException()
+
+						err = data[2]
+						ocrResult = data[0]
+						fileData: tuple[str, int, str] = data[1]
+						filePath = fileData[0]
+						fileSize = fileData[1]
+						fileHash = fileData[2]
+
+						fileIndex += 1
+						metrics.count('files')
+						if self.verbose:
+							print("building ocr {1}/{2}for: {0}".format(filePath, fileIndex, numFiles))
+						if isinstance(err, Exception):
+							print("exception: {0}: {1}".format(err, filePath))
+							metrics.count('errors')
+							continue
+
+						ocrText = ocrResult['text']
+						filterTime += ocrResult['filterTime']
+						metrics.count('bytes', fileSize or 0)
+						metrics.addWorkerTimes({'filter': ocrResult['filterTime'], 'ocr': ocrResult['ocrTime']})
+						if ocrResult['status'] == OCR_STATUS_SKIPPED:
+							numSkipped += 1
+							metrics.count('skipped')
+							if self.verbose:
+								print("skipped, no text found")
+						elif ocrResult['status'] == OCR_STATUS_TIMEOUT:
+							numTimeouts += 1
+							metrics.count('timeouts')
+							print("timed out after {0:.0f}s: {1}".format(ocrResult['ocrTime'], filePath))
+						elif ocrResult['status'] == OCR_STATUS_TOO_LARGE:
+							metrics.count('tooLarge')
+							print("too large to open: {0}".format(filePath))
+						else:
+							numOcred += 1
+							ocrTime += ocrResult['ocrTime']
+							if self.verbose:
+								print(str(ocrText).replace('\n', ' \\ '))
+						metrics.progress()
+						writer.add(ocrInsert, {
+							'hash': fileHash,
+							'size': fileSize,
+							'lang': ocrResult['lang'],
+							'text': ocrText,
+							'status': ocrResult['status']
+						})
+
+					finishedBatches[batchIndex] = [x[1][2] for x in batchData]
+					while nextBatch in finishedBatches:
+						for fileHash in finishedBatches.pop(nextBatch):
+							writer.advance(fileHash)
+						nextBatch += 1
+			writer.finish()
+		finally:
+			Image.MAX_IMAGE_PIXELS = prevPixelLimit
+			writer.close()
+			metrics.finish()
+			if numTimeouts:
+				print("{0} image(s) timed out, --forceocr retries them".format(numTimeouts))
+			self.printOcrSavings(numOcred, numSkipped, ocrTime, filterTime)
+		pass
 
-				fileIndex += 1
-				print("building ocr {1}/{2}for: {0}".format(filePath, fileIndex, numFiles))
-				if isinstance(err, Exception):
-					print("exception: {0}: {1}".format(err, filePath))
-					continue
+	def printOcrSavings(self, numOcred: int, numSkipped: int, ocrTime: float, filterTime: float):
+		if not numSkipped:
+			return
+		print("skipped {0} of {1} image(s) without text, text check took {2:.1f}s".format(
+			numSkipped, numSkipped + numOcred, filterTime))
+		if numOcred:
+			averageTime = ocrTime / numOcred
+			print("tesseract took {0:.2f}s per image, about {1:.1f}s of ocr saved".format(
+				averageTime, averageTime * numSkipped - filterTime))
+
+	def buildAnalysis(self, artifacts: list[str], ocrLang='eng', mask=None, workSize: Optional[int] = None, force: bool = False):
+		checkAnalyzeArtifacts(artifacts)
+		artifacts = [x for x in ANALYZE_ARTIFACTS if x in artifacts]
+		if not artifacts:
+			return
+		if workSize is None:
+			workSize = self.config.workSize
+		print("analyzing images: {0}".format(", ".join(artifacts)))
+		if ANALYZE_OCR in artifacts:
+			pytesseract.pytesseract.tesseract_cmd = self.config.tesscmd
+			print("tess languages: {0}".format(pytesseract.get_languages()))
+
+		metrics = self.startMetrics(STAGE_ANALYZE)
+		writer = self.makeStageWriter("analyze:{0}:{1}:{2}{3}".format(",".join(artifacts), ocrLang, mask or '', ':force' if force else ''), metrics)
+		hasDHash = exists().where(DHashData.hash == FileData.hash)
+		hasPal = exists().where(PaletteData.hash == FileData.hash)
+		hasOcr = self.getHasOcr(ocrLang, force)
+		#files sharing a hash are one group, so the mask only has to match one of their paths
+		ocrAllowed = func.max(self.getPathCondition(mask)) if mask else sqlalchemy.literal(True)
+
+		missingConditions = []
+		if ANALYZE_DHASH in artifacts:
+			missingConditions.append(~hasDHash)
+		if ANALYZE_PAL in artifacts:
+			missingConditions.append(~hasPal)
+		missingQuery = self.session.query(FileData.path, FileData.size, FileData.hash, hasDHash, hasPal, hasOcr, ocrAllowed) \
+			.filter(FileData.hash != DEFAULT_HASH) \
+			.group_by(FileData.hash) \
+			.order_by(FileData.hash)
+		if ANALYZE_OCR in artifacts:
+			missingQuery = missingQuery.having(sqlalchemy.or_(*missingConditions, (~hasOcr) & ocrAllowed))
+		else:
+			missingQuery = missingQuery.filter(sqlalchemy.or_(*missingConditions))
+		if writer.resumePosition is not None:
+			missingQuery = missingQuery.filter(FileData.hash > writer.resumePosition)
+
+		dhashSize = 8
+		minTextBlocks = 0 if force else self.config.ocrMinTextBlocks
+
+		def makeJobs():
+			for path, size, hash, fileHasDHash, fileHasPal, fileHasOcr, fileOcrAllowed in self.iterateByHash(missingQuery):
+				wanted = []
+				if (ANALYZE_DHASH in artifacts) and not fileHasDHash:
+					wanted.append(ANALYZE_DHASH)
+				if (ANALYZE_PAL in artifacts) and not fileHasPal:
+					wanted.append(ANALYZE_PAL)
+				if (ANALYZE_OCR in artifacts) and fileOcrAllowed and not fileHasOcr:
+					wanted.append(ANALYZE_OCR)
+				yield ((path, size, hash), wanted, dhashSize, self.config.tesscmd, ocrLang, workSize, minTextBlocks, self.getOcrLimits())
+
+		numFiles = missingQuery.count()
+		print("files to analyze: {0}".format(numFiles))
+		if not numFiles:
+			writer.finish()
+			metrics.finish()
+			return
+		metrics.total = numFiles
+		metrics.numWorkers = os.cpu_count()
+
+		inserts = {
+			ANALYZE_DHASH: makeInsert(DHashData.__table__),
+			ANALYZE_PAL: makeInsert(PaletteData.__table__),
+			ANALYZE_OCR: self.getOcrInsert(force)
+		}
+		fileIndex = 0
+		try:
+			with mp.Pool() as pool:
+				for data in metrics.wait(pool.imap(makeAnalysisData, makeJobs(), chunksize = 4)):
+					if not data:
+						raise OperationInterruptedException()
+					results = data[0]
+					fileData = data[1]
+					errors = data[2]
+					metrics.addWorkerTimes(data[3])
+
+					fileIndex += 1
+					metrics.count('files')
+					metrics.count('bytes', fileData[1] or 0)
+					metrics.count('errors', len(errors))
+					if self.verbose:
+						print("analyzing {1}/{2} ({3}) for: {0}".format(
+							fileData[0], fileIndex, numFiles, ", ".join(results)))
+					for artifact, err in errors:
+						print("exception ({0}): {1}: {2}".format(artifact, err, fileData[0]))
+					for artifact, newData in results.items():
+						metrics.count(artifact)
+						writer.add(inserts[artifact], newData)
+					metrics.progress()
+					writer.advance(fileData[2])
+			writer.finish()
+		finally:
+			writer.close()
+			metrics.finish()
+
+	def iterateByHash(self, query, batchSize: int = 10000):
+		#query has to select FileData.hash and be ordered by it. Pages are read on a connection of their own and by hash rather than
+		#through one open cursor: the stage commits on the session in between, and pool.imap pulls jobs from its own thread
+		lastHash = None
+		while True:
+			pageQuery = query if lastHash is None else query.filter(FileData.hash > lastHash)
+			with self.engine.connect() as conn:
+				rows = conn.execute(pageQuery.limit(batchSize).statement).all()
+			yield from rows
+			if len(rows) < batchSize:
+				return
+			lastHash = rows[-1].hash
 
-				ocrText = ocrTuple[0]
-				ocrLang = ocrTuple[1]
+	def checkWorkSizeDrift(self, numSamples: int, workSize: Optional[int] = None):
+		if workSize is None:
+			workSize = self.config.workSize
+		if workSize <= 0:
+			print("work size is 0 (full decode), set workSize in config or pass --worksize")
+			return
+		samples = self.session.query(FileData.path) \
+			.filter(FileData.hash != DEFAULT_HASH) \
+			.group_by(FileData.hash) \
+			.order_by(func.random()) \
+			.limit(numSamples).all()
+		print("comparing full decode against work size {0} on {1} file(s)".format(workSize, len(samples)))
 
-				print(str(ocrText).replace('\n', ' \\ '))
-				newData = OcrData(
-					hash = fileHash,
-					size = fileSize,
-					lang = ocrLang,
-					text = ocrText
-				)
-				#print(newData)
-				self.session.add(newData)
-				# if (fileIndex % fileLimit) == 0:
-				# 	print("saving due to file limit: {0}".format(fileLimit))
-				# 	self.session.commit()
-				
-		print("commiting")
+		dhashSize = 8
+		numChecked = 0
+		samePalettes = 0
+		sameMainColors = 0
+		sameDHashes = 0
+		dhashDistances = []
+		fullTime = 0.0
+		reducedTime = 0.0
+		for sample in samples:
+			path = sample[0]
+			try:
+				startTime = time.monotonic()
+				fullPal = getPaletteString(path)
+				fullDHash = getDHash(path, dhashSize)
+				midTime = time.monotonic()
+				reducedPal = getPaletteString(path, workSize)
+				reducedDHash = getDHash(path, dhashSize, workSize)
+				endTime = time.monotonic()
+			except Exception as e:
+				print("exception: {0}: {1}".format(e, path))
+				continue
+			numChecked += 1
+			fullTime += midTime - startTime
+			reducedTime += endTime - midTime
+			distance = bin(int(fullDHash, 16) ^ int(reducedDHash, 16)).count('1')
+			dhashDistances.append(distance)
+			samePalettes += fullPal == reducedPal
+			sameMainColors += fullPal[:1] == reducedPal[:1]
+			sameDHashes += distance == 0
+			if (fullPal != reducedPal) or distance:
+				print("{0}: palette {1} -> {2}, dhash distance {3}".format(path, fullPal, reducedPal, distance))
+
+		if not numChecked:
+			return
+		print("identical palettes: {0}/{1} ({2:.1f}%)".format(samePalettes, numChecked, samePalettes * 100.0 / numChecked))
+		print("identical main color: {0}/{1} ({2:.1f}%)".format(sameMainColors, numChecked, sameMainColors * 100.0 / numChecked))
+		print("identical dhashes: {0}/{1} ({2:.1f}%)".format(sameDHashes, numChecked, sameDHashes * 100.0 / numChecked))
+		print("dhash distance: mean {0:.2f}, max {1} bits of {2}".format(
+			sum(dhashDistances) / numChecked, max(dhashDistances), dhashSize * dhashSize * 2))
+		print("time: full {0:.2f}s, reduced {1:.2f}s ({2:.1f}x)".format(
+			fullTime, reducedTime, fullTime / max(reducedTime, 1e-6)))
+
+	def remapPalettes(self):
+		print("remapping palettes from stored histograms")
+		palettesTable = PaletteData.__table__
+		numMissing = self.session.query(PaletteData.id).filter(PaletteData.histogram == None).count()
+		if numMissing:
+			print("{0} palette(s) have no stored histogram and are left as they are. --killpal and --pal once to remap them too".format(numMissing))
+
+		palUpdate = sqlalchemy.update(palettesTable) \
+			.where(palettesTable.c.id == sqlalchemy.bindparam('palId')) \
+			.values(
+				palette = sqlalchemy.bindparam('palString'),
+				colorMask = sqlalchemy.bindparam('palMask'),
+				mainColor = sqlalchemy.bindparam('palMain')
+			)
+		batchSize = 10000
+		lastId = 0
+		numRemapped = 0
+		numChanged = 0
+		while True:
+			rows = self.session.execute(
+				sqlalchemy.select(palettesTable.c.id, palettesTable.c.palette, palettesTable.c.histogram)
+					.where(palettesTable.c.histogram != None)
+					.where(palettesTable.c.id > lastId)
+					.order_by(palettesTable.c.id)
+					.limit(batchSize)
+			).all()
+			if not rows:
+				break
+			lastId = rows[-1][0]
+			palStrings = getHistogramPaletteStrings(unpackHistograms([x[2] for x in rows]))
+			changed = [
+				{'palId': x[0], 'palString': palString, 'palMask': getColorMask(palString), 'palMain': palString[:1]}
+				for x, palString in zip(rows, palStrings) if x[1] != palString
+			]
+			if changed:
+				self.session.execute(palUpdate, changed)
+			numRemapped += len(rows)
+			numChanged += len(changed)
+			print("remapped {0} palettes, {1} changed".format(numRemapped, numChanged))
+
+		print("comitting")
 		self.session.commit()
-		pass
+		print("done")
+
+	def getDHashStore(self, dhashSize: int = 8) -> DHashStore:
+		store = DHashStore(self.config.dbpath, dhashSize)
+		store.sync(self.session)
+		return store
+
+	def getDHashIndex(self, dhashSize: int = 8) -> DHashIndex:
+		store = self.getDHashStore(dhashSize)
+		signature = store.getSignature()
+		indexPath = "{0}.dhidx.npz".format(self.config.dbpath)
+		index = DHashIndex.load(indexPath, signature)
+		if index is not None:
+			return index
+
+		ids, words = store.load()
+		print("building dhash index for {0} hashes".format(len(ids)))
+		index = DHashIndex(np.array(ids, dtype=np.int64), np.array(words, dtype=np.uint64))
+		try:
+			index.save(indexPath, signature)
+		except OSError as e:
+			print("cannot save dhash index {0}: {1}".format(indexPath, e))
+		return index
+
+	def getDHashPaths(self, dhashIds: list[int]) -> dict[int, list[str]]:
+		result = {}
+		queryLimit = 500
+		for i in range(0, len(dhashIds), queryLimit):
+			pathQuery = self.session.query(DHashData.id, FileData.path) \
+				.filter(DHashData.hash == FileData.hash) \
+				.filter(DHashData.id.in_(dhashIds[i:i + queryLimit])) \
+				.order_by(FileData.path)
+			for dhashId, path in pathQuery:
+				result.setdefault(dhashId, []).append(path)
+		return result
+
+	def findSimilar(self, path: str, maxDist: int, brief: bool = False):
+		dhashSize = 8
+		queryHash = getDHash(path, dhashSize)
+		store = self.getDHashStore(dhashSize)
+		startTime = time.monotonic()
+		foundIds, distances = store.scan(parseDHashes([queryHash]), maxDist)
+		if not brief:
+			print("scanned {0} hashes in {1:.3f}s".format(store.meta['entries'], time.monotonic() - startTime))
+
+		matches = sorted(zip(distances.tolist(), foundIds.tolist()))
+		if not brief:
+			print("{0} similar image hash(es) within {1} bits of {2}".format(len(matches), maxDist, queryHash))
+		paths = self.getDHashPaths([x[1] for x in matches])
+		for distance, dhashId in matches:
+			for matchPath in paths.get(dhashId, []):
+				if brief:
+					print(matchPath)
+				else:
+					print("{0}: {1}".format(distance, matchPath))
+
+	def findNearDupes(self, maxDist: int, brief: bool = False):
+		dhashSize = 8
+		index = self.getDHashIndex(dhashSize)
+		print("searching near duplicates within {0} bits".format(maxDist))
+		queryIndices, entryIndices, distances = index.findPairs(index.words, maxDist)
+
+		parents = list(range(len(index.words)))
+		def findRoot(x):
+			while parents[x] != x:
+				parents[x] = parents[parents[x]]
+				x = parents[x]
+			return x
+		for a, b in zip(queryIndices.tolist(), entryIndices.tolist()):
+			if a < b:
+				rootA = findRoot(a)
+				rootB = findRoot(b)
+				if rootA != rootB:
+					parents[rootB] = rootA
+
+		groups: dict[int, list[int]] = {}
+		for entry in range(len(index.words)):
+			groups.setdefault(findRoot(entry), []).extend(int(index.ids[x]) for x in index.getRows(entry))
+		groups = [x for x in groups.values() if len(x) > 1]
+		if not brief:
+			print("{0} group(s) of near duplicates".format(len(groups)))
+
+		paths = self.getDHashPaths([x for group in groups for x in group])
+		for groupIndex, group in enumerate(groups):
+			groupPaths = sorted(x for dhashId in group for x in paths.get(dhashId, []))
+			if not groupPaths:
+				continue
+			if not brief:
+				print("\ngroup {0}:".format(groupIndex + 1))
+			for groupPath in groupPaths:
+				print(groupPath)
 
 	def killPalettes(self):
 		print("deleting palettes")
@@ -816,55 +3018,122 @@ class DbProcessor:
 		print("done")
 		pass
 
-	def buildPalettes(self):
-		missingPal = self.session.query(FileData) \
+	def buildPalettes(self, workSize: Optional[int] = None):
+		if workSize is None:
+			workSize = self.config.workSize
+		metrics = self.startMetrics(STAGE_PAL)
+		writer = self.makeStageWriter('pal', metrics)
+		missingPal = self.session.query(FileData.path, FileData.size, FileData.hash) \
 			.filter(FileData.hash != DEFAULT_HASH) \
 			.filter(~ exists().where(FileData.hash == PaletteData.hash)) \
-			.group_by(FileData.hash)
+			.group_by(FileData.hash) \
+			.order_by(FileData.hash)
+		if writer.resumePosition is not None:
+			missingPal = missingPal.filter(FileData.hash > writer.resumePosition)
 
 		print(missingPal)
 
 		numFiles = missingPal.count()
 		print("missing palettes: {0}".format(numFiles))
-		with mp.Pool() as pool:
-			fileIndex = 0
-			for curData in pool.imap(makePaletteData, missingPal.all(), chunksize = 8):
-				if not curData:
-				 	raise OperationInterruptedException()
-				newData = curData[0]
-				filePath = curData[1]
-				err = curData[2]
-				if err and isinstance(err, KeyboardInterrupt):
-				 	raise OperationInterruptedException()
-				if err and isinstance(err, Exception):
-					print("exception: \"{0}\" in file: \"{1}\"".format(err, filePath))
-					continue
-				if isinstance(err, OSError):
-					print("os error: {0}".format(err))
-					continue
-				fileIndex += 1
-				print("building palette {1}/{2} ({3}) for: {0}".format(filePath, fileIndex, numFiles, newData.palette))
-				#print(newData)
-				self.session.add(newData)
-
-		self.session.commit()
+		if not numFiles:
+			writer.finish()
+			metrics.finish()
+			return
+		metrics.total = numFiles
+		metrics.numWorkers = os.cpu_count()
+		palInsert = makeInsert(PaletteData.__table__)
+		batchSize = 16
+		try:
+			with mp.Pool() as pool:
+				fileIndex = 0
+				palJobs = ((tuple(x), workSize) for x in missingPal.all())
+				for batch in metrics.wait(pool.imap(makePaletteDataBatch, makeBatches(palJobs, batchSize))):
+					if not batch:
+						raise OperationInterruptedException()
+					for curData in batch:
+						newData = curData[0]
+						filePath = curData[1]
+						err = curData[2]
+						metrics.addWorkerTimes(curData[3])
+						metrics.count('files')
+						if err and isinstance(err, KeyboardInterrupt):
+							raise OperationInterruptedException()
+						if err and isinstance(err, Exception):
+							print("exception: \"{0}\" in file: \"{1}\"".format(err, filePath))
+							metrics.count('errors')
+							continue
+						fileIndex += 1
+						metrics.count('bytes', newData['size'] or 0)
+						if self.verbose:
+							print("building palette {1}/{2} ({3}) for: {0}".format(filePath, fileIndex, numFiles, newData['palette']))
+						metrics.progress()
+						#print(newData)
+						writer.add(palInsert, newData)
+						writer.advance(newData['hash'])
+			writer.finish()
+		finally:
+			writer.close()
+			metrics.finish()
 		pass
 
 	def __init__(self) -> None:
 		self.config = Config.getConfig()
 		self.engine = create_engine("sqlite:///{0}".format(self.config.dbpath))
+		sqlalchemy.event.listen(self.engine, "connect", self.setPragmas)
 		Base.metadata.create_all(self.engine)
+		self.upgradeSchema()
 
 		Session = sessionmaker(bind = self.engine)
 		self.session: sqlalchemy.orm.Session = Session()
+		#per file output, otherwise long stages only print a progress line every config.progressSeconds
+		self.verbose = False
+		self.profileStage: Optional[str] = None
+		self.stageMetrics: dict[str, StageMetrics] = {}
 
 		pass
 
+	def setPragmas(self, dbapiConnection, connectionRecord) -> None:
+		cursor = dbapiConnection.cursor()
+		try:
+			for name, value in self.config.sqlitePragmas.items():
+				if not re.fullmatch(r'\w+', name) or not re.fullmatch(r'-?\w+', str(value)):
+					print("ignoring sqlite pragma {0} = {1}".format(name, value))
+					continue
+				cursor.execute("PRAGMA {0} = {1}".format(name, value))
+		finally:
+			cursor.close()
+
+	def upgradeSchema(self) -> None:
+		#create_all only creates missing tables, columns added to existing models need an ALTER
+		inspector = sqlalchemy.inspect(self.engine)
+		with self.engine.begin() as conn:
+			for table in Base.metadata.sorted_tables:
+				existing = set(x['name'] for x in inspector.get_columns(table.name))
+				for column in table.columns:
+					if column.name in existing:
+						continue
+					print("adding column {0}.{1}".format(table.name, column.name))
+					conn.execute(sqlalchemy.text('ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(
+						table.name, column.name, column.type.compile(dialect=self.engine.dialect))))
+				existingIndexes = set(x['name'] for x in inspector.get_indexes(table.name))
+				for index in table.indexes:
+					if index.name in existingIndexes:
+						continue
+					if index.unique:
+						columns = [x.name for x in index.columns]
+						print("removing duplicate {0} rows by {1}".format(table.name, ", ".join(columns)))
+						print("removed {0} rows".format(deleteDuplicates(conn, table, columns)))
+					print("creating index {0}".format(index.name))
+					index.create(bind=conn)
+
+	def pickRandom(self) -> Optional[str]:
+		rec = self.session.query(FileData.path).order_by(func.random()).first()
+		return rec[0] if rec else None
+
 	def openRandom(self) -> None:
-		rec = self.session.query(FileData).order_by(func.random()).first()
-		if not rec:
+		path = self.pickRandom()
+		if not path:
 			return
-		path = rec.path
 		fullPath = Path(path)
 		path = fullPath.absolute()
 		print(path)
@@ -873,13 +3142,61 @@ class DbProcessor:
 		#subprocess.call(['start', path])
 		#os.open(path)
 
-	def colorLike(self, colorQuery: str, brief: bool):
+	def fillPaletteColors(self) -> None:
+		#palettes from before colorMask existed, or imported ones
+		palettesTable = PaletteData.__table__
+		palUpdate = sqlalchemy.update(palettesTable) \
+			.where(palettesTable.c.id == sqlalchemy.bindparam('palId')) \
+			.values(colorMask = sqlalchemy.bindparam('palMask'), mainColor = sqlalchemy.bindparam('palMain'))
+		numFilled = 0
+		while True:
+			rows = self.session.execute(
+				sqlalchemy.select(palettesTable.c.id, palettesTable.c.palette)
+					.where(palettesTable.c.colorMask == None)
+					.limit(10000)
+			).all()
+			if not rows:
+				break
+			self.session.execute(palUpdate, [
+				{'palId': x[0], 'palMask': getColorMask(x[1] or ""), 'palMain': (x[1] or "")[:1]} for x in rows
+			])
+			numFilled += len(rows)
+			print("filled color masks for {0} palettes".format(numFilled))
+		if numFilled:
+			self.session.commit()
+
+	def getMaskCondition(self, hasColors: str = "", noColors: str = ""):
+		#colorMask & required == required and colorMask & forbidden == 0, as a list of masks so the index is used
+		requiredMask = getColorMask(hasColors)
+		forbiddenMask = getColorMask(noColors)
+		if requiredMask & forbiddenMask:
+			return sqlalchemy.false()
+		allMasks = range(1 << len(paletteLetters))
+		return PaletteData.colorMask.in_([
+			x for x in allMasks if ((x & requiredMask) == requiredMask) and not (x & forbiddenMask)
+		])
+
+	def getPatternCondition(self, colorQuery: str):
+		#index friendly conditions implied by the pattern, the ilike still decides
+		conditions = []
+		literals = "".join(re.split('[%_]', colorQuery))
+		if any(x.upper() not in paletteLetters for x in literals):
+			return PaletteData.palette.ilike(colorQuery)
+		if literals:
+			conditions.append(self.getMaskCondition(literals))
+		if colorQuery[:1] not in ('%', '_', ''):
+			conditions.append(PaletteData.mainColor == colorQuery[:1].upper())
+		conditions.append(PaletteData.palette.ilike(colorQuery))
+		return sqlalchemy.and_(*conditions)
+
+	def printColors(self, colorCondition, brief: bool):
+		self.fillPaletteColors()
 		colors = self.session.query(
 			PaletteData.palette, FileData.path
 		).join(
 			# PaletteData, (FileData.hash == PaletteData.hash) & (FileData.size == PaletteData.size)
 			PaletteData, (FileData.hash == PaletteData.hash)
-		).filter(PaletteData.palette.ilike(colorQuery)).order_by(PaletteData.palette, FileData.path).distinct()
+		).filter(colorCondition).order_by(PaletteData.palette, FileData.path).distinct()
 		
 		if not brief:
 			numResults = colors.count()
@@ -898,10 +3215,16 @@ class DbProcessor:
 			print("{0}".format(path))
 		#print(colors.all())
 
+	def colorLike(self, colorQuery: str, brief: bool):
+		self.printColors(self.getPatternCondition(colorQuery), brief)
+
 	def findColor(self, col: str, mainColor: bool, brief: bool):
 		colorQuery = "{0}%".format(col) if mainColor else "%{0}%".format(col)
 		self.colorLike(colorQuery, brief)
 
+	def findColorSet(self, hasColors: str, noColors: str, brief: bool):
+		self.printColors(self.getMaskCondition(hasColors or "", noColors or ""), brief)
+
 	def listColors(self):
 		print("listing colors")
 		colors = self.session.query(
@@ -922,69 +3245,275 @@ class DbProcessor:
 		#print(colors.all())
 		pass
 
-	def exportJson(self, filepath):
+	def exportJson(self, filepath, histograms: bool = False):
+		if isStreamJsonPath(filepath):
+			self.exportJsonLines(filepath, histograms)
+			return
 		with open(filepath, "w", encoding="utf8") as outFile:
 			outData = {}
 			outData['files'] = [
 				(x.path, x.hash, x.size, datetime.timestamp(x.ctime), datetime.timestamp(x.mtime)) for x in self.session.query(FileData).all()
 			]
 			outData['pal'] = [
-				(x.hash, x.size, x.palette) for x in self.session.query(PaletteData).all()
+				(x.hash, x.size, x.palette, encodeJsonBlob(x.histogram) if histograms else None) for x in self.session.query(PaletteData).all()
 			]
 			outData['dhash'] = [
 				(x.hash, x.size, x.dhash, x.hashSize) for x in self.session.query(DHashData).all()
 			]
 			outData['ocr'] = [
-				(x.hash, x.size, x.lang, x.text) for x in self.session.query(OcrData).all()
+				(x.hash, x.size, x.lang, x.text, x.status) for x in self.session.query(OcrData).all()
 			]
 			json.dump(outData, outFile, indent='\t')
 
+	def insertRows(self, table, rows, batchSize: int = 10000) -> int:
+		numRows = 0
+		for batch in makeBatches(rows, batchSize):
+			self.session.execute(makeInsert(table), batch)
+			numRows += len(batch)
+		return numRows
+
 	def importJson(self, filepath):
+		if isStreamJsonPath(filepath):
+			self.importJsonLines(filepath)
+			return
 		with open(filepath, "r", encoding="utf8") as inFile:
 			inData = json.load(inFile)
 			print('adding files')
-			for x in inData['files']:
-				newData = FileData(
-					path = x[0],
-					hash = x[1],
-					size = x[2],
-					ctime = datetime.fromtimestamp(x[3]),
-					mtime = datetime.fromtimestamp(x[4])
-				)
-				self.session.add(newData)
+			self.insertRows(FileData.__table__, ({
+					'path': x[0],
+					'hash': x[1],
+					'size': x[2],
+					'ctime': datetime.fromtimestamp(x[3]),
+					'mtime': datetime.fromtimestamp(x[4])
+				} for x in inData['files']))
 			print('adding palettes')
-			for x in inData['pal']:
-				newData = PaletteData(
-					hash = x[0],
-					size = x[1],
-					palette = x[2]
-				)
-				self.session.add(newData)
+			self.insertRows(PaletteData.__table__, ({
+					'hash': x[0],
+					'size': x[1],
+					'histogram': decodeJsonBlob(getJsonField(x, 3)),
+					**getPaletteColors(x[2])
+				} for x in inData['pal']))
 			print('adding dhash')
-			for x in inData['dhash']:
-				newData = DHashData(
-					hash = x[0],
-					size = x[1],
-					dhash = x[2],
-					hashSize = x[3]
-				)
-				self.session.add(newData)
+			self.insertRows(DHashData.__table__, ({
+					'hash': x[0],
+					'size': x[1],
+					'dhash': x[2],
+					'hashSize': x[3]
+				} for x in inData['dhash']))
 			print('adding ocr')
-			for x in inData['ocr']:
-				newData = OcrData(
-					hash = x[0],
-					size = x[1],
-					lang = x[2],
-					text = x[3]
-				)
-				self.session.add(newData)
+			self.insertRows(OcrData.__table__, ({
+					'hash': x[0],
+					'size': x[1],
+					'lang': x[2],
+					'text': x[3],
+					'status': getJsonField(x, 4)
+				} for x in inData['ocr']))
 			print('comitting')
 			self.session.commit()
 			print('done')
 	
+	def getExportRecords(self, batchSize: int = 10000, histograms: bool = False):
+		#same fields as exportJson, one section at a time
+		filesTable = FileData.__table__
+		for x in self.session.execute(sqlalchemy.select(
+			filesTable.c.path, filesTable.c.hash, filesTable.c.size, filesTable.c.ctime, filesTable.c.mtime
+		)).yield_per(batchSize):
+			yield [JSONL_FILES, x[0], x[1], x[2], datetime.timestamp(x[3]), datetime.timestamp(x[4])]
+		palTable = PaletteData.__table__
+		palHistogram = palTable.c.histogram if histograms else sqlalchemy.null()
+		for x in self.session.execute(sqlalchemy.select(
+			palTable.c.hash, palTable.c.size, palTable.c.palette, palHistogram
+		)).yield_per(batchSize):
+			yield [JSONL_PAL, x[0], x[1], x[2], encodeJsonBlob(x[3])]
+		dhashTable = DHashData.__table__
+		for x in self.session.execute(sqlalchemy.select(
+			dhashTable.c.hash, dhashTable.c.size, dhashTable.c.dhash, dhashTable.c.hashSize
+		)).yield_per(batchSize):
+			yield [JSONL_DHASH, *x]
+		ocrTable = OcrData.__table__
+		for x in self.session.execute(sqlalchemy.select(
+			ocrTable.c.hash, ocrTable.c.size, ocrTable.c.lang, ocrTable.c.text, ocrTable.c.status
+		)).yield_per(batchSize):
+			yield [JSONL_OCR, *x]
+
+	def exportJsonLines(self, filepath, histograms: bool = False):
+		numRecords = 0
+		with open(filepath, "w", encoding="utf8") as outFile:
+			for record in self.getExportRecords(histograms=histograms):
+				outFile.write(json.dumps(record, ensure_ascii=False))
+				outFile.write("\n")
+				numRecords += 1
+				if not (numRecords % 100000):
+					print("exported {0} records".format(numRecords))
+		print("exported {0} records".format(numRecords))
+
+	def importJsonLines(self, filepath, batchSize: int = 10000):
+		makeRows = {
+			JSONL_FILES: (FileData.__table__, lambda x: {
+				'path': x[0],
+				'hash': x[1],
+				'size': x[2],
+				'ctime': datetime.fromtimestamp(x[3]),
+				'mtime': datetime.fromtimestamp(x[4])
+			}),
+			JSONL_PAL: (PaletteData.__table__, lambda x: {
+				'hash': x[0],
+				'size': x[1],
+				'histogram': decodeJsonBlob(getJsonField(x, 3)),
+				**getPaletteColors(x[2])
+			}),
+			JSONL_DHASH: (DHashData.__table__, lambda x: {
+				'hash': x[0],
+				'size': x[1],
+				'dhash': x[2],
+				'hashSize': x[3]
+			}),
+			JSONL_OCR: (OcrData.__table__, lambda x: {
+				'hash': x[0],
+				'size': x[1],
+				'lang': x[2],
+				'text': x[3],
+				'status': getJsonField(x, 4)
+			})
+		}
+		pending = {x: [] for x in makeRows}
+		numRecords = 0
+
+		def flush(section):
+			if pending[section]:
+				self.session.execute(makeInsert(makeRows[section][0]), pending[section])
+				pending[section] = []
+
+		with open(filepath, "r", encoding="utf8") as inFile:
+			for lineIndex, line in enumerate(inFile):
+				if not line.strip():
+					continue
+				record = json.loads(line)
+				section = record[0]
+				if section not in makeRows:
+					print("skipping unknown record \"{0}\" on line {1}".format(section, lineIndex + 1))
+					continue
+				pending[section].append(makeRows[section][1](record[1:]))
+				if len(pending[section]) >= batchSize:
+					flush(section)
+				numRecords += 1
+				if not (numRecords % 100000):
+					print("imported {0} records".format(numRecords))
+		for section in pending:
+			flush(section)
+		print("imported {0} records".format(numRecords))
+		print('comitting')
+		self.session.commit()
+		print('done')
+
+	def getSnapshotQuery(self, tableName: str, columns: list[str]):
+		table = Base.metadata.tables[tableName]
+		if tableName == 'files':
+			return sqlalchemy.select(*[table.c[x] for x in columns]).order_by(table.c.id)
+		filesTable = FileData.__table__
+		fileRef = sqlalchemy.select(func.min(filesTable.c.id)) \
+			.where(filesTable.c.hash == table.c.hash) \
+			.where(table.c.hash != DEFAULT_HASH) \
+			.scalar_subquery()
+		values = []
+		for name in columns:
+			if name == 'fileRef':
+				values.append(fileRef.label('fileRef'))
+			elif name == 'hash':
+				values.append(sqlalchemy.case((fileRef == None, table.c.hash), else_=DEFAULT_HASH).label('hash'))
+			else:
+				values.append(table.c[name])
+		return sqlalchemy.select(*values).order_by(table.c.id)
+
+	def exportSnapshot(self, filepath, histograms: bool = False):
+		#magic, version, then chunks: json header length, json header, zlib compressed column blocks
+		with open(filepath, "wb") as outFile:
+			outFile.write(SNAPSHOT_MAGIC)
+			outFile.write(struct.pack('<I', SNAPSHOT_VERSION))
+			for tableName, columns in SNAPSHOT_TABLES.items():
+				columns = [x for x in columns if histograms or (x[0] not in SNAPSHOT_OPTIONAL)]
+				query = self.getSnapshotQuery(tableName, [x[0] for x in columns])
+				numRows = 0
+				for rows in self.session.execute(query).yield_per(SNAPSHOT_CHUNK_ROWS).partitions():
+					header = {'table': tableName, 'rows': len(rows), 'columns': []}
+					blocks = []
+					for index, (name, kind) in enumerate(columns):
+						meta, data = packSnapshotColumn(kind, [x[index] for x in rows])
+						block = zlib.compress(data, 6)
+						meta['name'] = name
+						meta['bytes'] = len(block)
+						header['columns'].append(meta)
+						blocks.append(block)
+					headerData = json.dumps(header).encode("utf8")
+					outFile.write(struct.pack('<I', len(headerData)))
+					outFile.write(headerData)
+					for block in blocks:
+						outFile.write(block)
+					numRows += len(rows)
+				print("{0}: {1} rows".format(tableName, numRows))
+		print("snapshot size: {0} bytes".format(os.path.getsize(filepath)))
+
+	def importSnapshot(self, filepath):
+		for tableName in SNAPSHOT_TABLES:
+			if self.session.execute(sqlalchemy.select(Base.metadata.tables[tableName].c.id).limit(1)).first():
+				print("table {0} is not empty, snapshots can only be restored into an empty database".format(tableName))
+				return
+
+		filesTable = FileData.__table__
+		numRows = {}
+		with open(filepath, "rb") as inFile:
+			if inFile.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+				print("{0} is not a snapshot".format(filepath))
+				return
+			version = struct.unpack('<I', inFile.read(4))[0]
+			if version > SNAPSHOT_VERSION:
+				print("snapshot version {0} is newer than supported {1}".format(version, SNAPSHOT_VERSION))
+				return
+			while True:
+				lengthData = inFile.read(4)
+				if not lengthData:
+					break
+				header = json.loads(inFile.read(struct.unpack('<I', lengthData)[0]).decode("utf8"))
+				tableName = header['table']
+				chunkRows = header['rows']
+				columns = {}
+				for meta in header['columns']:
+					columns[meta['name']] = unpackSnapshotColumn(meta, zlib.decompress(inFile.read(meta['bytes'])), chunkRows)
+				if tableName not in SNAPSHOT_TABLES:
+					print("skipping unknown table {0}".format(tableName))
+					continue
+				table = Base.metadata.tables[tableName]
+				rows = [dict(zip(columns.keys(), x)) for x in zip(*columns.values())]
+				if tableName == 'palettes':
+					for row in rows:
+						row.update(getPaletteColors(row['palette'] or ""))
+
+				#the hash of referenced files is looked up by sqlite, not kept around here
+				refRows = [x for x in rows if x.get('fileRef') is not None]
+				plainRows = [x for x in rows if x.get('fileRef') is None]
+				for row in rows:
+					row.pop('fileRef', None)
+				if refRows:
+					refInsert = makeInsert(table).values(
+						hash = sqlalchemy.select(filesTable.c.hash)
+							.where(filesTable.c.id == sqlalchemy.bindparam('fileRef'))
+							.scalar_subquery()
+					)
+					for row, fileRef in zip(refRows, [x for x in columns['fileRef'] if x is not None]):
+						del row['hash']
+						row['fileRef'] = fileRef
+					self.session.execute(refInsert, refRows)
+				if plainRows:
+					self.session.execute(makeInsert(table), plainRows)
+				numRows[tableName] = numRows.get(tableName, 0) + chunkRows
+				print("{0}: {1} rows".format(tableName, numRows[tableName]))
+		print('comitting')
+		self.session.commit()
+		print('done')
+
 	def findFiles(self, pattern: str, brief: bool = False):
 		files = self.session.query(FileData.path) \
-			.filter(FileData.path.ilike(pattern)) \
+			.filter(self.getPathCondition(pattern)) \
 			.order_by(FileData.path)
 
 		if not brief:
@@ -994,92 +3523,72 @@ class DbProcessor:
 			print(x[0])
 
 	def killDupes(self):
-		print("cleaning duplicate palettes")
-		distinctPals = self.session.query(PaletteData.id) \
-			.group_by(PaletteData.hash)
-		killPals = self.session.query(PaletteData) \
-			.filter(~PaletteData.id.in_(distinctPals))
-
-		numToKill = killPals.count()
-		if (numToKill):
-			print("deleting {0} duplicate palettes".format(numToKill))
-
-			for x in killPals.all():
-				self.session.delete(x)
-		else:
-			print("no duplicate palettes")
-
-		print("cleaning duplicate image hashes")
-		distinctImHashes = self.session.query(DHashData.id) \
-			.group_by(DHashData.hash)
-		killImHashes = self.session.query(DHashData) \
-			.filter(~DHashData.id.in_(distinctImHashes))
-
-		numToKill = killImHashes.count()
-		if (numToKill):
-			print("deleting {0} duplicate imHashes".format(numToKill))
-
-			for x in killImHashes.all():
-				self.session.delete(x)
-				pass
-		else:
-			print("no duplicate image hashes")
-
-		print("cleaning ocr")
-		langList = self.session.query(OcrData.lang) \
-			.group_by(OcrData.lang)
-		langs = langList.all()
-		print("languages: {0}".format(langs))
-		for x in langs:
-			lang = x[0]
-			print("Cleaning: {0}".format(lang))
-			distinctOcr = self.session.query(OcrData.id) \
-				.filter(OcrData.lang == lang) \
-				.group_by(OcrData.hash)
-			distinctCount = distinctOcr.count()
-			killOcr = self.session.query(OcrData) \
-				.filter(OcrData.lang == lang) \
-				.filter(~OcrData.id.in_(distinctOcr))
-			killCount = killOcr.count()
-			print("Disctinct: {0}; kill: {1}".format(distinctCount, killCount))
-			if killCount > 0:
-				print("Cleaning {0} duplicates".format(killCount))
-				for x in killOcr.all():
-					self.session.delete(x)
-			else:
-				print("No duplicates to kill")
+		#unique indexes keep new duplicates out, this is for databases where they couldn't be created
+		duplicateKeys = [
+			(PaletteData.__table__, ['hash']),
+			(DHashData.__table__, ['hash', 'hashSize']),
+			(OcrData.__table__, ['hash', 'lang'])
+		]
+		for table, columns in duplicateKeys:
+			print("cleaning duplicate {0} by {1}".format(table.name, ", ".join(columns)))
+			numKilled = deleteDuplicates(self.session, table, columns)
+			print("deleted {0} duplicates".format(numKilled) if numKilled else "no duplicates")
 
 		print("comitting")
 		self.session.commit()
 		print("done")
 
-		pass
-
 	def commitSession(self):
 		self.session.commit()
 
 def buildParser():
 	parse = argparse.ArgumentParser()
 	parse.add_argument("--scan", help="scan filesystem", action="store_true")
+	parse.add_argument("--watch", help="keep watching filesystem and update database. Also builds stages given with --imghash, --pal and --ocr", action="store_true")
+	parse.add_argument("--pollinterval", help="seconds between directory polls when --watch cannot use inotify", action="store", type=float, default=60.0)
+	parse.add_argument("--fullscan", help="scan filesystem, checking every file even in unchanged directories", action="store_true")
 	parse.add_argument("--pal", help="build palettes", action="store_true")
 	parse.add_argument("--killpal", help="kill palettes", action="store_true")
+	parse.add_argument("--repal", help="rebuild palette strings from stored histograms without decoding images", action="store_true")
 	parse.add_argument("--killdupes", help="kill duplicate entries", action="store_true")
 	parse.add_argument("--hash", help="build file hashes", action="store_true")
+	parse.add_argument("--hashworkers", help="number of hashing workers, 0 for cpu count. Overrides config", action="store", type=int, default=None)
 	parse.add_argument("--imghash", help="build image hashes", action="store_true")
 	parse.add_argument("--ocr", help="ocr images", action="store_true")
+	parse.add_argument("--forceocr", help="ocr every image with --ocr or --analyze, including those the text check skipped before", action="store_true")
+	parse.add_argument("--ocrworkers", help="number of tesseract processes running at once, 0 for cpu count. Overrides config", action="store", type=int, default=None)
+	parse.add_argument("--worksize", help="decode images for dhash and palettes at reduced size, 0 for full size. Overrides config", action="store", type=int, default=None)
+	parse.add_argument("--driftcheck", help="compare palettes and dhashes of N random files between full and --worksize decoding", action="store", type=int, default=None)
+	parse.add_argument("--analyze", help="build image hashes, palettes and/or ocr from one image decode. Comma separated list of dhash,pal,ocr", 
+		action="store", nargs='?', type=parseAnalyzeArtifacts, const=[ANALYZE_DHASH, ANALYZE_PAL], default=None)
 	parse.add_argument("--killocr", help="kill ocr images", action="store_true")
 	parse.add_argument("--ocrmask", help="ocr file mask for ilike", action="store", default=None)
 	parse.add_argument("--lang", help="ocr language", action="store", default='eng')
 	parse.add_argument("--random", help="open random image", action="store_true")
+	parse.add_argument("--similar", help="list images whose dhash is within --maxdist bits of the given image", action="store")
+	parse.add_argument("--neardupes", help="list groups of images whose dhashes are within --maxdist bits", action="store_true")
+	parse.add_argument("--maxdist", help="max dhash bit distance for --similar and --neardupes", action="store", type=int, default=8)
 	parse.add_argument("--findmaincolor", help="list images with specified main colors. (ROYGBCMKLW)", action="store")
 	parse.add_argument("--findcolor", help="list images with specified colors (ROYGBCMKLW)", action="store")
 	parse.add_argument("--findfiles", help="list paths matchin pattern (ilike)", action="store")
 	parse.add_argument("--colorlike", help="color search using ilike syntax (ROYGBCMKLW)", action="store")
+	parse.add_argument("--hascolors", help="list images that have all of the specified colors, in any order (ROYGBCMKLW)", action="store")
+	parse.add_argument("--nocolors", help="list images that have none of the specified colors, combines with --hascolors (ROYGBCMKLW)", action="store")
 	parse.add_argument("--listcolors", help="list image colors", action="store_true")
 	parse.add_argument("--brief", help="print less stuff", action="store_true")
 	parse.add_argument("--exportjson", help="export database to file", action="store")
 	parse.add_argument("--importjson", help="import database from file", action="store")
-	parse.add_argument("--searchtext", help="search text in db. Uses ilike pattern", action="store")
+	parse.add_argument("--exportsnap", help="export database to a compact binary snapshot", action="store")
+	parse.add_argument("--importsnap", help="restore a binary snapshot into an empty database", action="store")
+	parse.add_argument("--snaphist", help="include palette histograms in --exportsnap and --exportjson, needed for --repal after restoring", action="store_true")
+	parse.add_argument("--searchtext", help="search text in db. Uses ilike pattern, or full text query with --fts", action="store")
+	parse.add_argument("--fts", help="--searchtext takes full text search queries (words, prefix*, \"phrases\"), results ranked by relevance", action="store_true")
+	parse.add_argument("--buildfts", help="build full text index for ocr text and substring index for paths", action="store_true")
+	parse.add_argument("--verbose", help="print a line for every file processed by scan, hash, imghash, pal, ocr and analyze. Scan skips the files of unchanged directories", action="store_true")
+	parse.add_argument("--statsjson", help="save counters and timers of the stages that ran to a json file", action="store")
+	parse.add_argument("--statsprom", help="save counters and timers of the stages that ran in prometheus textfile format", action="store")
+	parse.add_argument("--profile", help="run one stage under cProfile, saves imgdb-STAGE.prof and prints the slowest functions", 
+		action="store", choices=STAGE_NAMES)
 	return parse
 
 def main():
@@ -1091,46 +3600,70 @@ def main():
 	#print(args)
 	#print(args.scan)
 	dbProc = DbProcessor()
+	dbProc.verbose = args.verbose
+	dbProc.profileStage = args.profile
 	try:
-		if (args.scan):
-			dbProc.scanFilesystem()
+		if (args.scan or args.fullscan):
+			dbProc.runStage(STAGE_SCAN, dbProc.scanFilesystem, args.fullscan)
 		if (args.killpal):
 			dbProc.killPalettes()
+		if (args.repal):
+			dbProc.remapPalettes()
 		if (args.killocr):
 			dbProc.killOcr(args.lang)
 		if (args.hash):
-			dbProc.buildHashes()
+			dbProc.runStage(STAGE_HASH, dbProc.buildHashes, args.hashworkers)
 		if (args.imghash):
-			dbProc.buildDhashes()
+			dbProc.runStage(STAGE_DHASH, dbProc.buildDhashes, args.worksize)
 		if (args.ocr):
-			dbProc.buildOcr(args.lang, args.ocrmask)
+			dbProc.runStage(STAGE_OCR, dbProc.buildOcr, args.lang, args.ocrmask, args.ocrworkers, args.forceocr)
 		if (args.pal):
-			dbProc.buildPalettes()
+			dbProc.runStage(STAGE_PAL, dbProc.buildPalettes, args.worksize)
+		if (args.analyze):
+			dbProc.runStage(STAGE_ANALYZE, dbProc.buildAnalysis, 
+				args.analyze, args.lang, args.ocrmask, args.worksize, args.forceocr)
+		if (args.buildfts):
+			dbProc.buildFtsIndexes()
 		if (args.killdupes):
 			dbProc.killDupes()
+		if (args.watch):
+			dbProc.watchFilesystem(args.imghash, args.pal, args.ocr, args.lang, args.ocrmask, args.pollinterval)
 	except KeyboardInterrupt:
 		print("keyboard interrupt on lengthy operation. Saving to db.")
 		dbProc.commitSession()		
 	except OperationInterruptedException:
 		print("operation interrupted on lengthy operation. Saving to db.")
 		dbProc.commitSession()
+	dbProc.writeStats(args.statsjson, args.statsprom)
 
+	if (args.driftcheck):
+		dbProc.checkWorkSizeDrift(args.driftcheck, args.worksize)
 	if (args.findmaincolor):
 		dbProc.findColor(args.findmaincolor, True, args.brief)
 	if (args.findcolor):
 		dbProc.findColor(args.findcolor, False, args.brief)
 	if (args.colorlike):
 		dbProc.colorLike(args.colorlike, args.brief)
+	if (args.hascolors or args.nocolors):
+		dbProc.findColorSet(args.hascolors, args.nocolors, args.brief)
 	if (args.listcolors):
 		dbProc.listColors()
 	if (args.exportjson):
-		dbProc.exportJson(args.exportjson)
+		dbProc.exportJson(args.exportjson, args.snaphist)
 	if (args.importjson):
 		dbProc.importJson(args.importjson)
+	if (args.exportsnap):
+		dbProc.exportSnapshot(args.exportsnap, args.snaphist)
+	if (args.importsnap):
+		dbProc.importSnapshot(args.importsnap)
 	if (args.searchtext):
-		dbProc.searchText(args.searchtext, args.lang, args.brief)
+		dbProc.searchText(args.searchtext, args.lang, args.brief, args.fts)
 	if (args.findfiles):
 		dbProc.findFiles(args.findfiles, args.brief)
+	if (args.similar):
+		dbProc.findSimilar(args.similar, args.maxdist, args.brief)
+	if (args.neardupes):
+		dbProc.findNearDupes(args.maxdist, args.brief)
 
 	if (args.random):
 		dbProc.openRandom()
@@ -0,0 +1,288 @@
+import os, sys, json, re
+import argparse
+import contextlib
+import hashlib
+import itertools
+import random
+import shutil
+import sqlite3
+import tempfile
+import platform
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import imgdb
+
+FILL_SEED = 4321
+FILL_BATCH = 100000
+DUPLICATE_RATE = 0.05
+TEXT_RATE = 0.3
+EXTENSIONS = ['.jpg', '.png', '.bmp', '.tga']
+#words with a known share of ocr texts, so text queries have something to find
+RARE_WORDS = [('invoice', 0.01), ('receipt', 0.001)]
+
+def parseRowCount(value: str) -> int:
+	match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kKmM]?)\s*', value)
+	if not match:
+		raise argparse.ArgumentTypeError("bad row count {0}, expected something like 100000, 100k or 1m".format(value))
+	multiplier = {'': 1, 'k': 1000, 'm': 1000000}[match.group(2).lower()]
+	return int(float(match.group(1)) * multiplier)
+
+def parseRowCounts(value: str) -> list[int]:
+	return [parseRowCount(x) for x in value.split(',')]
+
+def makeFillPath(index: int) -> str:
+	return "img/d{0}/d{1}/file{2}{3}".format(index % 97, (index // 97) % 53, index, EXTENSIONS[index % len(EXTENSIONS)])
+
+def makeFillHash(index: int) -> str:
+	return hashlib.sha256(str(index).encode('utf8')).hexdigest()
+
+def makeFillText(rnd: random.Random, words: list[str]) -> str:
+	text = " ".join(rnd.choice(words) for x in range(rnd.randint(3, 30)))
+	for word, rate in RARE_WORDS:
+		if rnd.random() < rate:
+			text += " " + word
+	return text
+
+def makeFillPalette(rnd: random.Random, cumWeights: list[float]) -> str:
+	#skewed towards the first letters, like real palettes where a few colors dominate
+	letters = dict.fromkeys(rnd.choices(imgdb.paletteLetters, cum_weights=cumWeights, k=16))
+	return "".join(letters)[:rnd.randint(1, 8)]
+
+def fillDatabase(dbProc: imgdb.DbProcessor, numRows: int) -> None:
+	#one derived row per distinct hash, about DUPLICATE_RATE of the files are copies of an earlier one
+	rnd = random.Random(FILL_SEED)
+	cumWeights = list(itertools.accumulate(1.0 / (x + 1) for x in range(len(imgdb.paletteLetters))))
+	words = ["".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for y in range(rnd.randint(2, 10))) for x in range(5000)]
+	baseTime = datetime(2020, 1, 1)
+	numHashes = 0
+	for start in range(0, numRows, FILL_BATCH):
+		files = []
+		hashes = []
+		for index in range(start, min(start + FILL_BATCH, numRows)):
+			if numHashes and rnd.random() < DUPLICATE_RATE:
+				hashIndex = rnd.randrange(numHashes)
+			else:
+				hashIndex = numHashes
+				numHashes += 1
+				hashes.append(hashIndex)
+			fileTime = baseTime + timedelta(seconds=rnd.randrange(100000000))
+			files.append({
+				'path': makeFillPath(index),
+				'size': 1000 + (hashIndex * 7919) % 10000000,
+				'ctime': fileTime,
+				'mtime': fileTime,
+				'hash': makeFillHash(hashIndex)
+			})
+		palettes = []
+		dhashes = []
+		ocr = []
+		for hashIndex in hashes:
+			fileHash = makeFillHash(hashIndex)
+			fileSize = 1000 + (hashIndex * 7919) % 10000000
+			palettes.append(dict(imgdb.getPaletteColors(makeFillPalette(rnd, cumWeights)), hash=fileHash, size=fileSize, histogram=None))
+			dhashes.append({'hash': fileHash, 'size': fileSize, 'hashSize': 8, 'dhash': "{0:032x}".format(rnd.getrandbits(128))})
+			ocr.append({
+				'hash': fileHash, 'size': fileSize, 'lang': 'eng', 'status': None,
+				'text': makeFillText(rnd, words) if rnd.random() < TEXT_RATE else ""
+			})
+		#files go last, so an interrupted fill never looks complete
+		with dbProc.engine.begin() as conn:
+			conn.execute(imgdb.PaletteData.__table__.insert(), palettes)
+			conn.execute(imgdb.DHashData.__table__.insert(), dhashes)
+			conn.execute(imgdb.OcrData.__table__.insert(), ocr)
+			conn.execute(imgdb.FileData.__table__.insert(), files)
+		print("filled {0} of {1} files".format(min(start + FILL_BATCH, numRows), numRows))
+
+def getQueryCommands() -> list:
+	#(name, list of calls), the calls are cycled through over the runs
+	letters = imgdb.paletteLetters
+	return [
+		('colorLike', [
+			lambda db: db.colorLike("{0}%".format(letters[0]), False),
+			lambda db: db.colorLike("%{0}{1}%".format(letters[1], letters[0]), False),
+			lambda db: db.colorLike("{0}_{1}%".format(letters[0], letters[2]), False)
+		]),
+		('findColor', [
+			lambda db: db.findColor(letters[3], True, False),
+			lambda db: db.findColor(letters[5], False, False)
+		]),
+		('findColorSet', [
+			lambda db: db.findColorSet(letters[0] + letters[1], letters[2], False),
+			lambda db: db.findColorSet(letters[4], "", False)
+		]),
+		('listColors', [
+			lambda db: db.listColors()
+		]),
+		('searchText', [
+			lambda db: db.searchText("%invoice%", 'eng', False),
+			lambda db: db.searchText("%receipt%", 'eng', False)
+		]),
+		('searchFullText', [
+			lambda db: db.searchText("invoice", 'eng', False, True),
+			lambda db: db.searchText("receipt OR invoice", 'eng', False, True)
+		]),
+		('findFiles', [
+			lambda db: db.findFiles("%file12345%", False),
+			lambda db: db.findFiles("img/d7/d3/%", False),
+			lambda db: db.findFiles("%.tga", False)
+		]),
+		('pickRandom', [
+			lambda db: db.pickRandom()
+		])
+	]
+
+def getQueryPlan(conn, statement: str, parameters) -> list[str]:
+	rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+	depths = {0: -1}
+	plan = []
+	for nodeId, parentId, unused, detail in rows:
+		depths[nodeId] = depths.get(parentId, -1) + 1
+		plan.append("{0}{1}".format("  " * depths[nodeId], detail))
+	return plan
+
+def getFullScans(plan: list[str]) -> list[str]:
+	#only full scans of our own tables, fts lookups and scans of small subquery results are fine
+	tables = set(imgdb.Base.metadata.tables.keys())
+	scans = []
+	for line in plan:
+		match = re.match(r'SCAN (?:TABLE )?(\w+)', line.strip())
+		if match and match.group(1) in tables:
+			scans.append(line.strip())
+	return scans
+
+def benchCommand(dbProc: imgdb.DbProcessor, calls: list, repeat: int, budget: float) -> dict:
+	statements = {}
+	def captureStatement(conn, cursor, statement, parameters, context, executemany):
+		if statement not in statements:
+			statements[statement] = parameters
+
+	times = []
+	listener = (dbProc.engine, "before_cursor_execute", captureStatement)
+	sqlalchemy.event.listen(*listener)
+	try:
+		startTime = time.perf_counter()
+		for runIndex in range(repeat):
+			dbProc.session.expire_all()
+			callStart = time.perf_counter()
+			with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+				calls[runIndex % len(calls)](dbProc)
+			times.append(time.perf_counter() - callStart)
+			if time.perf_counter() - startTime > budget:
+				break
+	finally:
+		sqlalchemy.event.remove(*listener)
+	dbProc.session.commit()
+
+	results = []
+	with dbProc.engine.connect() as conn:
+		for statement, parameters in statements.items():
+			if not statement.lstrip().upper().startswith("SELECT"):
+				continue
+			plan = getQueryPlan(conn, statement, parameters)
+			results.append({
+				'sql': statement,
+				'plan': plan,
+				'fullScans': getFullScans(plan)
+			})
+
+	p50, p99 = np.percentile(times, [50, 99])
+	return {
+		'runs': len(times),
+		'p50': float(p50),
+		'p99': float(p99),
+		'mean': float(np.mean(times)),
+		'statements': results
+	}
+
+def openDatabase(workDir: str, numRows: int) -> imgdb.DbProcessor:
+	config = imgdb.Config()
+	config.dbpath = "query{0}.db".format(numRows)
+	config.save(os.path.join(workDir, imgdb.Config.DEFAULT_PATH))
+	return imgdb.DbProcessor()
+
+def benchRowCount(workDir: str, numRows: int, repeat: int, budget: float, verbose: bool) -> dict:
+	dbProc = openDatabase(workDir, numRows)
+	try:
+		fillSeconds = None
+		if dbProc.session.query(imgdb.func.count(imgdb.FileData.id)).scalar() != numRows:
+			dbProc.session.close()
+			dbProc.engine.dispose()
+			for name in os.listdir(workDir):
+				if name.startswith(dbProc.config.dbpath):
+					os.remove(os.path.join(workDir, name))
+			dbProc = openDatabase(workDir, numRows)
+			print("filling {0} rows".format(numRows))
+			startTime = time.perf_counter()
+			fillDatabase(dbProc, numRows)
+			fillSeconds = time.perf_counter() - startTime
+		else:
+			print("reusing {0}".format(dbProc.config.dbpath))
+		#indexes that queries would otherwise build on first use
+		with open(os.devnull, "w") as devNull, contextlib.redirect_stdout(devNull):
+			dbProc.fillPaletteColors()
+			dbProc.buildFtsIndexes()
+
+		commands = {}
+		for name, calls in getQueryCommands():
+			result = benchCommand(dbProc, calls, repeat, budget)
+			commands[name] = result
+			scans = sorted(set(x for statement in result['statements'] for x in statement['fullScans']))
+			print("{0:>16}: p50 {1:9.2f} ms, p99 {2:9.2f} ms, {3:3} runs{4}".format(
+				name, result['p50'] * 1000.0, result['p99'] * 1000.0, result['runs'],
+				"  FULL SCAN: {0}".format("; ".join(scans)) if scans else ""))
+			if verbose:
+				for statement in result['statements']:
+					print("\n{0}\n{1}\n".format(statement['sql'], "\n".join(statement['plan'])))
+
+		return {
+			'fillSeconds': fillSeconds,
+			'dbBytes': os.path.getsize(dbProc.config.dbpath),
+			'commands': commands
+		}
+	finally:
+		dbProc.session.close()
+		dbProc.engine.dispose()
+
+def main():
+	parse = argparse.ArgumentParser(description="measure imgdb query latency on generated databases")
+	parse.add_argument("--rows", help="comma separated file counts to fill, like 100k,1m", action="store", type=parseRowCounts, default="100k,1m,10m")
+	parse.add_argument("--repeat", help="runs per query command", action="store", type=int, default=20)
+	parse.add_argument("--budget", help="stop repeating a command after this many seconds", action="store", type=float, default=60.0)
+	parse.add_argument("--workdir", help="keep generated databases here and reuse them between runs instead of a temporary directory", action="store", default=None)
+	parse.add_argument("--output", help="json file for the results", action="store", default=None)
+	parse.add_argument("--verbose", help="print every statement with its query plan", action="store_true")
+	args = parse.parse_args()
+
+	workDir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="imgdbquery")
+	os.makedirs(workDir, exist_ok=True)
+	prevDir = os.getcwd()
+	os.chdir(workDir)
+	try:
+		results = {}
+		for numRows in args.rows:
+			print("\n{0} files:".format(numRows))
+			results[str(numRows)] = benchRowCount(workDir, numRows, args.repeat, args.budget, args.verbose)
+	finally:
+		os.chdir(prevDir)
+		if not args.workdir:
+			shutil.rmtree(workDir, ignore_errors=True)
+
+	outputPath = args.output or "querybench-{0}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+	with open(outputPath, "w", encoding="utf8") as outFile:
+		json.dump({
+			'date': datetime.now().isoformat(timespec='seconds'),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'sqlite': sqlite3.sqlite_version,
+			'sqlalchemy': sqlalchemy.__version__,
+			'results': results
+		}, outFile, indent='\t')
+	print("results saved to {0}".format(outputPath))
+
+if __name__ == "__main__":
+	main()